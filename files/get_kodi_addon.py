@@ -2,12 +2,23 @@
 
 import abc
 import argparse
+import base64
+import collections
+import concurrent.futures
 import contextlib
 import copy
+import errno
+import fcntl
 import functools
 import glob
+import gzip
 import hashlib
+import http.client
+import http.server
+import io
+import json
 import logging
+import marshal
 import os
 import pwd
 import re
@@ -17,16 +28,22 @@ import sqlite3
 import stat
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
 import time
 import urllib.parse
+import urllib.request
 import xml.etree.ElementTree as ET
+import zipfile
 
 try:
-    from packaging.version import Version as V
+    from packaging.version import InvalidVersion, Version as V
 except ImportError:
     from distutils.version import LooseVersion
 
+    InvalidVersion = ValueError
+
     @functools.total_ordering
     class V:
         def __init__(self, vstring):
@@ -74,6 +91,15 @@ except ImportError:
             return self._loose_version == other
 
 
+# Kodi repositories list versions that are not valid PEP 440 (say,
+# `2.0.0~beta1`); those are kept as their raw strings.
+def parse_version(vstring):
+    try:
+        return V(vstring)
+    except InvalidVersion:
+        return vstring
+
+
 if sys.maxsize > 2**32:
     blake2 = hashlib.blake2b
 else:
@@ -126,19 +152,9 @@ def gunzip(*args, **kwargs):
     return subprocess.run(["gunzip", *args], **kwargs)
 
 
-def gunzip_into(target, *args, **kwargs):
-    # `delete_on_close` introduced in 3.12; don't rely on it.
-    with tempfile.NamedTemporaryFile(dir=os.path.dirname(target), delete=False) as out:
-        kwargs.update(stdout=out)
-        try:
-            gunzip("-c", *args, **kwargs).check_returncode()
-            os.rename(out.name, target)
-        except Exception as e:
-            with contextlib.suppress(FileNotFoundError):
-                os.remove(out.name)
-            raise e
-
-    return target
+def is_gzip(path):
+    with open(path, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
 
 
 def kodi_send(*args, host="localhost", port=9777, **kwargs):
@@ -154,7 +170,1276 @@ def rmtree(path):
         os.chmod(path, stat.S_IWRITE)
         func(path)
 
-    return shutil.rmtree(path, onexc=remove_readonly)
+    # `onexc` replaced `onerror` in Python 3.12.
+    if sys.version_info >= (3, 12):
+        return shutil.rmtree(path, onexc=remove_readonly)
+    else:
+        return shutil.rmtree(path, onerror=remove_readonly)
+
+
+# Linux `FICLONE` ioctl, from <linux/fs.h>
+FICLONE = 0x40049409
+
+
+# Copy-on-write clone of `source` (like `cp --reflink=auto`), falling back to
+# a regular copy on filesystems that do not support it.
+def reflink(source, target):
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, dst)
+    shutil.copystat(source, target)
+    return target
+
+
+# Hard-link `source` to `target`, falling back to a regular copy across
+# filesystems.
+def hardlink(source, target):
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(source, target)
+    return target
+
+
+def file_digest(path, chunk_size=1 << 16, h=None):
+    h = blake2() if h is None else h
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Checksum files published next to repository files and packages, in order of
+# preference, and the length of their hex digests.
+CHECKSUM_KINDS = {"sha256": 64, "md5": 32}
+
+
+# Parse a checksum file, which holds the hex digest, optionally followed by
+# the file name (as written by `md5sum`).
+def parse_checksum(kind, text):
+    digest = text.strip().split(None, 1)[0].lower() if text.strip() else ""
+    if not re.match(r"^[0-9a-f]{{{0}}}$".format(CHECKSUM_KINDS[kind]), digest):
+        raise ValueError("not a {0} checksum: {1!r}".format(kind, text[:80]))
+    return digest
+
+
+# Checksums are written as "<kind>:<hex digest>" in bundles and lockfiles.
+def checksum_to_str(checksum):
+    return None if checksum is None else "{0}:{1}".format(*checksum)
+
+
+def checksum_from_str(s):
+    if s is None:
+        return None
+    kind, _, digest = s.partition(":")
+    return kind, parse_checksum(kind, digest)
+
+
+# Read `<addon_id>/addon.xml` from a package, without extracting it.
+def package_addon_xml(source, addon_id):
+    try:
+        with zipfile.ZipFile(source) as archive:
+            with archive.open("{0}/addon.xml".format(addon_id)) as f:
+                return ET.parse(f).getroot()
+    except (KeyError, zipfile.BadZipFile, ET.ParseError) as e:
+        raise Exception(
+            "'{0}' is not a valid package of '{1}': {2}".format(source, addon_id, e)
+        )
+
+
+# Parse a `curl --dump-header` file.  With `--location`, the file holds one
+# header block per response; only the final response matters.
+def parse_response_headers(path):
+    headers = {}
+    with open(path, "r", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if line.upper().startswith("HTTP/"):
+                headers = {}
+            elif ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+# HTTP cache validators for a cached file are stored in a JSON sidecar file
+# next to it.
+def validators_file(path):
+    return "{0}.validators".format(path)
+
+
+def read_validators(path):
+    with contextlib.suppress(FileNotFoundError, ValueError):
+        with open(validators_file(path), "r") as f:
+            return json.load(f)
+    return {}
+
+
+def write_validators(path, validators):
+    if validators:
+        write_atomically(validators_file(path), json.dumps(validators).encode())
+    else:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(validators_file(path))
+
+
+def response_validators(headers):
+    return {
+        name: headers[name] for name in ("etag", "last-modified") if name in headers
+    }
+
+
+# Headers for resuming the download of a partial file.  Without validators,
+# there is no way to tell whether the partial file still matches the server's
+# copy, so the download starts over.
+def resume_headers(partial):
+    with contextlib.suppress(FileNotFoundError):
+        offset = os.path.getsize(partial)
+        validators = read_validators(partial)
+        validator = validators.get("etag", validators.get("last-modified"))
+        if offset > 0 and validator is not None:
+            return offset, {"Range": "bytes={0}-".format(offset), "If-Range": validator}
+
+    return 0, {}
+
+
+# The size the downloaded file should have after a 200 or 206 response, if
+# the server said.
+def expected_size(status, headers):
+    if status == 206:
+        match = re.match(r"bytes \d+-\d+/(\d+)$", headers.get("content-range", ""))
+        return int(match.group(1)) if match else None
+
+    with contextlib.suppress(KeyError, ValueError):
+        return int(headers["content-length"])
+
+    return None
+
+
+def remove_partial(partial):
+    for path in (partial, validators_file(partial)):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+# Write `data` to `path` such that readers see either the old or the new
+# content, never a partially-written file.
+def write_atomically(path, data, mode=None):
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as out:
+        try:
+            if mode is not None:
+                os.fchmod(out.fileno(), mode)
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+            os.replace(out.name, path)
+        except Exception as e:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(out.name)
+            raise e
+
+    return path
+
+
+# Downloading, archive validation and extraction, and decompression.  The
+# `subprocess` backend shells out to `curl`, `unzip` and `gunzip`; the
+# `native` backend does everything in-process, reusing HTTP connections.
+class SubprocessIO:
+    name = "subprocess"
+
+    CURL_ARGS = ["-f", "-s", "-L", "-S", "--retry", "5", "--retry-all-errors"]
+
+    def __deepcopy__(self, memo):
+        return self
+
+    # `curl` exit statuses meaning that the server would not resume the
+    # transfer (no range support, or a range beyond the end of the file).
+    RESUME_FAILED = (33, 36)
+
+    # Download `url` into `output`.  Returns the HTTP status code, the
+    # (lowercased) response headers of the final response and, with
+    # `hash_name`, the hex digest of the downloaded file.  Without `retry`,
+    # only one attempt is made.
+    #
+    # With `resume`, an existing `output` is taken to be the beginning of the
+    # file, and `curl` is asked to continue from its end (including when it
+    # retries); the response's validators are kept next to `output`, so that
+    # a later attempt can resume it, too.
+    def download(
+        self, url, output, headers={}, resume=False, retry=True, hash_name=None
+    ):
+        dump = "{0}.headers".format(output)
+        cmd = [*self.CURL_ARGS, "-o", output, "-D", dump, "-w", "%{http_code}"]
+        if not retry:
+            cmd += ["--retry", "0"]
+
+        offset, extra = resume_headers(output) if resume else (0, {})
+        if offset > 0:
+            logging.info("Resuming '{0}' at byte {1}".format(url, offset))
+            cmd += ["-H", "If-Range: {0}".format(extra["If-Range"])]
+        else:
+            remove_partial(output)
+        if resume:
+            cmd += ["-C", "-"]
+
+        for name, value in headers.items():
+            cmd += ["-H", "{0}: {1}".format(name, value)]
+
+        # Single attempts are for optional files, which need not be reported.
+        def run(*args):
+            result = curl(
+                *cmd,
+                *args,
+                url,
+                stdout=subprocess.PIPE,
+                stderr=None if retry else subprocess.DEVNULL,
+                text=True,
+            )
+            return result, int(result.stdout.strip()[-3:] or 0)
+
+        try:
+            if offset > 0:
+                # Find out whether the server resumes at all before spending
+                # `curl`'s retries on it.
+                result, status = run("--retry", "0")
+                if result.returncode in self.RESUME_FAILED or status == 416:
+                    logging.info("Cannot resume '{0}'; starting over".format(url))
+                    remove_partial(output)
+                    return self.download(
+                        url, output, headers, resume=True, retry=retry, hash_name=hash_name
+                    )
+                if result.returncode != 0 and retry:
+                    result, status = run()
+            else:
+                result, status = run()
+
+            # Report HTTP errors like the native backend does, so that callers
+            # can tell them apart from connection failures.
+            if result.returncode == 22 and status >= 400:
+                raise _HTTPStatusError(
+                    "server returned HTTP status {0} for '{1}'".format(status, url),
+                    status,
+                )
+            result.check_returncode()
+
+            # `curl` writes the file itself, so hash it afterwards.
+            digest = None
+            if hash_name is not None and status != 304:
+                digest = file_digest(output, h=hashlib.new(hash_name))
+
+            return status, parse_response_headers(dump), digest
+        finally:
+            if resume and os.path.isfile(dump):
+                validators = response_validators(parse_response_headers(dump))
+                if validators:
+                    write_validators(output, validators)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(dump)
+
+    # Send a single `HEAD` request for `url`, without retrying, and return
+    # the HTTP status code.
+    def probe(self, url, timeout):
+        result = curl(
+            "-s",
+            "-I",
+            "-o",
+            os.devnull,
+            "-w",
+            "%{http_code}",
+            "--max-time",
+            str(timeout),
+            url,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        result.check_returncode()
+        return int(result.stdout.strip()[-3:])
+
+    # A package whose checksum has been verified needs no separate check.
+    def extract_zip(self, source, output, verified=False):
+        if not verified:
+            logging.info("Checking that '{0}' is a zip file".format(source))
+            looks_like_zip(source).check_returncode()
+
+        logging.info("Unzipping '{0}' into '{1}'".format(source, output))
+        unzip_to_dir(output, source)
+
+    # Stream the decompressed content of `source` (or `source` itself, if it
+    # is not gzip-compressed) without writing it to disk.
+    @contextlib.contextmanager
+    def open_decompressed(self, source):
+        if not is_gzip(source):
+            with open(source, "rb") as f:
+                yield f
+            return
+
+        with subprocess.Popen(["gunzip", "-c", source], stdout=subprocess.PIPE) as proc:
+            try:
+                yield proc.stdout
+            finally:
+                proc.stdout.close()
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+class NativeIO:
+    name = "native"
+
+    RETRIES = 5
+    MAX_REDIRECTS = 50
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self):
+        # `http.client` connections are not thread-safe; keep a pool of
+        # keep-alive connections (one per scheme, host and port) per thread.
+        self._local = threading.local()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @property
+    def connections(self):
+        try:
+            return self._local.connections
+        except AttributeError:
+            self._local.connections = {}
+            return self._local.connections
+
+    def connection(self, url):
+        key = (url.scheme, url.netloc)
+        with contextlib.suppress(KeyError):
+            return self.connections[key], True
+
+        self.connections[key] = self.open_connection(url)
+        return self.connections[key], False
+
+    # The proxy to reach `url` through (from the usual `*_proxy` environment
+    # variables), as a split URL, or None.
+    @staticmethod
+    def proxy_for(url):
+        if urllib.request.proxy_bypass(url.hostname or ""):
+            return None
+
+        proxy = urllib.request.getproxies().get(url.scheme)
+        if not proxy:
+            return None
+        if "://" not in proxy:
+            proxy = "http://{0}".format(proxy)
+        return urllib.parse.urlsplit(proxy)
+
+    # Credentials in the proxy URL, like curl sends them.
+    @staticmethod
+    def proxy_headers(proxy):
+        if proxy.username is None:
+            return {}
+
+        credentials = "{0}:{1}".format(
+            urllib.parse.unquote(proxy.username),
+            urllib.parse.unquote(proxy.password or ""),
+        )
+        return {
+            "Proxy-Authorization": "Basic {0}".format(
+                base64.b64encode(credentials.encode()).decode()
+            )
+        }
+
+    # HTTPS goes through a `CONNECT` tunnel to the proxy; plain HTTP is sent
+    # to the proxy as absolute-URI requests (see `request_target`), as many
+    # proxies only allow `CONNECT` to port 443.
+    def open_connection(self, url, timeout=60):
+        if url.scheme == "https":
+            cls = http.client.HTTPSConnection
+        elif url.scheme == "http":
+            cls = http.client.HTTPConnection
+        else:
+            raise ValueError("unsupported URL scheme '{0}'".format(url.scheme))
+
+        proxy = self.proxy_for(url)
+        if proxy is None:
+            return cls(url.netloc, timeout=timeout)
+
+        proxy_address = (proxy.hostname, proxy.port or 80)
+        if url.scheme == "http":
+            return http.client.HTTPConnection(*proxy_address, timeout=timeout)
+
+        conn = cls(*proxy_address, timeout=timeout)
+        conn.set_tunnel(url.hostname, url.port, headers=self.proxy_headers(proxy))
+        return conn
+
+    # The request target and any extra headers for requesting `url` over a
+    # connection from `open_connection`.
+    def request_target(self, url):
+        path = urllib.parse.urlunsplit(("", "", url.path or "/", url.query, ""))
+        if url.scheme != "http":
+            return path, {}
+
+        proxy = self.proxy_for(url)
+        if proxy is None:
+            return path, {}
+
+        return (
+            urllib.parse.urlunsplit(
+                (url.scheme, url.netloc, url.path or "/", url.query, "")
+            ),
+            self.proxy_headers(proxy),
+        )
+
+    def discard(self, url):
+        with contextlib.suppress(KeyError):
+            self.connections.pop((url.scheme, url.netloc)).close()
+
+    # Probes use a connection of their own, as they run on short-lived
+    # threads and should not wait for the usual timeout.
+    def probe(self, url, timeout):
+        parsed = urllib.parse.urlsplit(url)
+        conn = self.open_connection(parsed, timeout=timeout)
+        try:
+            target, proxy_headers = self.request_target(parsed)
+            conn.request("HEAD", target, headers=proxy_headers)
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+    # See `SubprocessIO.download`.  Each retry resumes from wherever the
+    # previous attempt stopped.  The digest is computed while writing.
+    def download(
+        self, url, output, headers={}, resume=False, retry=True, hash_name=None
+    ):
+        if not resume:
+            remove_partial(output)
+
+        delay = 1
+        attempt = 0
+        while True:
+            try:
+                return self._download(url, output, headers, resume, hash_name)
+            except _StaleConnection:
+                # The server closed a kept-alive connection; retry at once.
+                continue
+            except (OSError, http.client.HTTPException, _HTTPStatusError) as e:
+                attempt += 1
+                if (
+                    not retry
+                    or attempt > self.RETRIES
+                    or not getattr(e, "transient", True)
+                ):
+                    raise
+                logging.warning(
+                    "Error fetching '{0}' ({1}); retrying in {2} second(s)".format(
+                        url, e, delay
+                    )
+                )
+                time.sleep(delay)
+                delay *= 2
+
+    def _download(self, url, output, headers, resume, hash_name):
+        offset, extra = resume_headers(output) if resume else (0, {})
+        if offset > 0:
+            logging.info("Resuming '{0}' at byte {1}".format(url, offset))
+
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parsed = urllib.parse.urlsplit(url)
+            conn, reused = self.connection(parsed)
+            target, proxy_headers = self.request_target(parsed)
+
+            try:
+                conn.request("GET", target, headers={**headers, **extra, **proxy_headers})
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError) as e:
+                self.discard(parsed)
+                if reused:
+                    raise _StaleConnection() from e
+                raise
+            except Exception:
+                self.discard(parsed)
+                raise
+
+            try:
+                status = response.status
+                response_headers = {
+                    name.lower(): value for name, value in response.getheaders()
+                }
+
+                if status in (301, 302, 303, 307, 308) and "location" in response_headers:
+                    response.read()
+                    url = urllib.parse.urljoin(url, response_headers["location"])
+                    continue
+
+                if status == 416 and offset > 0:
+                    # The partial file is no prefix of the server's copy.
+                    response.read()
+                    logging.info("Cannot resume '{0}'; starting over".format(url))
+                    remove_partial(output)
+                    offset, extra = 0, {}
+                    continue
+
+                if status >= 400:
+                    response.read()
+                    raise _HTTPStatusError(
+                        "server returned HTTP status {0} for '{1}'".format(status, url),
+                        status,
+                    )
+
+                if status != 304:
+                    # Anything but a 206 (e.g. because the file changed, or
+                    # because the server ignores ranges) holds the whole file.
+                    append = status == 206 and offset > 0
+                    if append and not response_headers.get(
+                        "content-range", ""
+                    ).startswith("bytes {0}-".format(offset)):
+                        remove_partial(output)
+                        raise _HTTPStatusError(
+                            "server returned an unexpected range for '{0}'".format(url)
+                        )
+                    if resume:
+                        write_validators(output, response_validators(response_headers))
+
+                    h = None
+                    if hash_name is not None:
+                        h = hashlib.new(hash_name)
+                        if append:
+                            file_digest(output, h=h)
+
+                    with open(output, "ab" if append else "wb") as out:
+                        for chunk in iter(lambda: response.read(self.CHUNK_SIZE), b""):
+                            out.write(chunk)
+                            if h is not None:
+                                h.update(chunk)
+                        size = out.tell()
+
+                    # `read` returns short, rather than failing, when the
+                    # connection drops; fail so that the retry resumes.
+                    expected = expected_size(status, response_headers)
+                    if expected is not None and size < expected:
+                        raise http.client.IncompleteRead(b"", expected - size)
+
+                    return status, response_headers, None if h is None else h.hexdigest()
+
+                response.read()
+                return status, response_headers, None
+            except Exception:
+                self.discard(parsed)
+                raise
+            finally:
+                if response.will_close:
+                    self.discard(parsed)
+
+        raise _HTTPStatusError("too many redirects for '{0}'".format(url))
+
+    # Opening the archive validates its central directory, and reading each
+    # member verifies its CRC, so there is no separate listing pass.
+    def extract_zip(self, source, output, verified=False):
+        logging.info("Unzipping '{0}' into '{1}'".format(source, output))
+        with contextlib.suppress(FileExistsError):
+            os.makedirs(output)
+
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                mode = info.external_attr >> 16
+                path = self.extraction_path(source, output, info.filename)
+                if stat.S_ISLNK(mode):
+                    target = archive.read(info).decode()
+                    if os.path.isabs(target) or ".." in target.split("/"):
+                        raise Exception(
+                            "Refusing to extract symlink '{0}' -> '{1}' from '{2}'".format(
+                                info.filename, target, source
+                            )
+                        )
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.symlink(target, path)
+                    continue
+
+                path = archive.extract(info, output)
+                if mode and not info.is_dir():
+                    os.chmod(path, stat.S_IMODE(mode))
+
+    # Where the member `name` of `source` goes under `output`.  Members may
+    # neither escape `output` nor be written through symlinks (extracted
+    # earlier, or already there); a symlink in the way of a file is replaced.
+    @staticmethod
+    def extraction_path(source, output, name):
+        parts = [part for part in name.split("/") if part not in ("", ".")]
+        if name.startswith("/") or ".." in parts or not parts:
+            raise Exception(
+                "Refusing to extract '{0}' from '{1}'".format(name, source)
+            )
+
+        path = output
+        for part in parts[:-1]:
+            path = os.path.join(path, part)
+            if os.path.islink(path):
+                raise Exception(
+                    "Refusing to extract '{0}' from '{1}' through symlink '{2}'".format(
+                        name, source, path
+                    )
+                )
+        path = os.path.join(path, parts[-1])
+
+        if os.path.islink(path):
+            os.remove(path)
+
+        real_output = os.path.realpath(output)
+        if os.path.commonpath([real_output, os.path.realpath(path)]) != real_output:
+            raise Exception(
+                "Refusing to extract '{0}' from '{1}' outside '{2}'".format(
+                    name, source, output
+                )
+            )
+
+        return path
+
+    @contextlib.contextmanager
+    def open_decompressed(self, source):
+        if is_gzip(source):
+            f = gzip.open(source, "rb")
+        else:
+            f = open(source, "rb")
+
+        with f:
+            yield f
+
+
+class _HTTPStatusError(Exception):
+    # Like `curl --retry`, only retry on statuses that may go away.
+    TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def transient(self):
+        return self.status is None or self.status in self.TRANSIENT_STATUSES
+
+
+class _StaleConnection(Exception):
+    pass
+
+
+IO_BACKENDS = {backend.name: backend for backend in (NativeIO, SubprocessIO)}
+
+
+# Already-extracted addon packages, keyed by the digest of the package
+# archive, from which addon directories are materialized without unzipping.
+#
+# Layout:
+#   <path>/<digest>/<addon-id>/...  extracted package trees
+#   <path>/refs.json                addon directory -> digest it came from
+class PackageStore:
+    MATERIALIZERS = {
+        "hardlink": hardlink,
+        "reflink": reflink,
+        "copy": shutil.copy2,
+    }
+
+    # Serializes `refs.json` updates among threads; `flock` does the same
+    # among processes.
+    _refs_lock = threading.Lock()
+
+    def __init__(self, path, io_backend):
+        self.path = path
+        self.io_backend = io_backend
+
+    @property
+    def refs_file(self):
+        return os.path.join(self.path, "refs.json")
+
+    def tree(self, digest):
+        return os.path.join(self.path, digest)
+
+    # Extract `source` into the store, unless it is there already.
+    def add(self, source, verified=False):
+        digest = file_digest(source)
+        tree = self.tree(digest)
+
+        if os.path.isdir(tree):
+            logging.info("Using stored package tree '{0}'".format(tree))
+            return digest
+
+        with contextlib.suppress(FileExistsError):
+            os.makedirs(self.path)
+
+        staging = tempfile.mkdtemp(dir=self.path, prefix=".{0}.".format(digest))
+        try:
+            self.io_backend.extract_zip(source, staging, verified=verified)
+            os.rename(staging, tree)
+        except OSError as e:
+            # Another process stored the same package first.
+            if not os.path.isdir(tree):
+                raise e
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                rmtree(staging)
+
+        return digest
+
+    # Replace `target` with a copy of the stored tree for `addon_id`, built
+    # next to `target` and then renamed into place.
+    def materialize(self, digest, addon_id, target, mode):
+        source = os.path.join(self.tree(digest), addon_id)
+        if not os.path.isdir(source):
+            raise Exception(
+                "Package '{0}' does not contain directory '{1}'".format(digest, addon_id)
+            )
+
+        parent = os.path.dirname(target)
+        with contextlib.suppress(FileExistsError):
+            os.makedirs(parent)
+
+        staging = tempfile.mkdtemp(dir=parent, prefix=".{0}.new.".format(addon_id))
+        try:
+            shutil.copytree(
+                source,
+                staging,
+                symlinks=True,
+                copy_function=self.MATERIALIZERS[mode],
+                dirs_exist_ok=True,
+            )
+            os.chmod(staging, stat.S_IMODE(os.stat(source).st_mode))
+
+            if os.path.lexists(target):
+                retired = tempfile.mkdtemp(
+                    dir=parent, prefix=".{0}.old.".format(addon_id)
+                )
+                os.rename(target, os.path.join(retired, addon_id))
+                os.rename(staging, target)
+                rmtree(retired)
+            else:
+                os.rename(staging, target)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                rmtree(staging)
+
+        self.update_refs({os.path.abspath(target): digest})
+
+    @contextlib.contextmanager
+    def locked_refs(self):
+        with contextlib.suppress(FileExistsError):
+            os.makedirs(self.path)
+
+        with self._refs_lock, open(os.path.join(self.path, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            refs = {}
+            with contextlib.suppress(FileNotFoundError, ValueError):
+                with open(self.refs_file, "r") as f:
+                    refs = json.load(f)
+            yield refs
+            write_atomically(self.refs_file, json.dumps(refs, indent=2).encode())
+
+    def update_refs(self, new_refs):
+        with self.locked_refs() as refs:
+            refs.update(new_refs)
+
+    # Held (shared) by installs from adding a package tree until its
+    # reference is recorded, and (exclusively) by `gc`, so that `gc` never
+    # removes a tree that is about to be referenced.  Installs do not wait
+    # for each other.
+    @contextlib.contextmanager
+    def in_use(self, exclusive=False):
+        with contextlib.suppress(FileExistsError):
+            os.makedirs(self.path)
+
+        with open(os.path.join(self.path, ".gc.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    # Staging directories younger than this may belong to a run that is
+    # still extracting into them (say, one from an older version of this
+    # script, which does not take the `in_use` lock).
+    STALE_STAGING_SECONDS = 24 * 60 * 60
+
+    # Remove package trees that no existing addon directory was materialized
+    # from, along with references to addon directories that no longer exist,
+    # and staging directories left behind long ago by interrupted runs.
+    def gc(self):
+        if not os.path.isdir(self.path):
+            return []
+
+        removed = []
+        with self.in_use(exclusive=True), self.locked_refs() as refs:
+            for target in list(refs):
+                if not os.path.isdir(target):
+                    del refs[target]
+
+            live = set(refs.values())
+            for entry in os.listdir(self.path):
+                path = os.path.join(self.path, entry)
+                if not os.path.isdir(path) or entry in live:
+                    continue
+                if (
+                    entry.startswith(".")
+                    and time.time() - os.path.getmtime(path)
+                    < self.STALE_STAGING_SECONDS
+                ):
+                    continue
+                logging.info("Removing unreferenced package tree '{0}'".format(path))
+                rmtree(path)
+                removed.append(entry)
+
+        return removed
+
+
+# Latency and failure statistics for repository mirrors (datadirs), kept in
+# `mirrors.json` in the cache directory, and used to try the fastest healthy
+# mirror first.  Mirrors without recent statistics are probed concurrently.
+class MirrorSelector:
+    PROBE_TIMEOUT = 5
+
+    # Weight of the newest sample in the latency moving average.
+    LATENCY_WEIGHT = 0.3
+
+    _stats_lock = threading.Lock()
+
+    def __init__(self, path, io_backend, ttl, jobs=1):
+        self.path = path
+        self.io_backend = io_backend
+        self.ttl = ttl
+        # The number of mirrors to probe concurrently
+        self.jobs = jobs
+        self._stats = None
+        self._dirty = False
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @property
+    def stats(self):
+        if self._stats is None:
+            self._stats = {}
+            with contextlib.suppress(FileNotFoundError, ValueError):
+                with open(self.path, "r") as f:
+                    self._stats = json.load(f)
+
+        return self._stats
+
+    def fresh(self, url):
+        return (
+            url in self.stats
+            and time.time() - self.stats[url].get("checked", 0) <= self.ttl
+        )
+
+    # Healthy mirrors first, fastest first; unknown mirrors keep their
+    # relative order, after the healthy ones.
+    def sort_key(self, url):
+        entry = self.stats.get(url, {})
+        return (
+            entry.get("consecutive_failures", 0) > 0,
+            entry.get("latency", float("inf")),
+        )
+
+    # Return `urls` ordered by preference, probing them all first unless
+    # their statistics are recent (or we are offline).
+    def rank(self, urls, offline=False):
+        urls = list(urls)
+        if len(urls) < 2:
+            return urls
+
+        if not offline and not all(self.fresh(url) for url in urls):
+            self.probe_all(urls)
+
+        return sorted(urls, key=self.sort_key)
+
+    def probe_all(self, urls):
+        def probe(url):
+            start = time.monotonic()
+            try:
+                status = self.io_backend.probe(url, self.PROBE_TIMEOUT)
+                if status >= 500:
+                    raise Exception("server returned HTTP status {0}".format(status))
+            except Exception as e:
+                logging.info("Mirror '{0}' did not respond: {1}".format(url, e))
+                return url, None, e
+
+            latency = time.monotonic() - start
+            logging.info("Mirror '{0}' responded in {1:.3f}s".format(url, latency))
+            return url, latency, None
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(urls), self.jobs)
+        ) as executor:
+            results = list(executor.map(probe, urls))
+
+        for url, latency, error in results:
+            self.record(url, latency, error)
+
+    # Record the outcome of a probe or download from `url`.  Latency samples
+    # are only taken from probes; downloads just update the failure counters.
+    # Nothing is written until `save`, once per run.
+    def record(self, url, latency=None, error=None):
+        with self._stats_lock:
+            self._dirty = True
+            entry = self.stats.setdefault(url, {})
+            entry["checked"] = time.time()
+            if error is None:
+                entry["successes"] = entry.get("successes", 0) + 1
+                entry["consecutive_failures"] = 0
+                if latency is not None:
+                    entry["latency"] = (
+                        latency
+                        if "latency" not in entry
+                        else (1 - self.LATENCY_WEIGHT) * entry["latency"]
+                        + self.LATENCY_WEIGHT * latency
+                    )
+            else:
+                entry["failures"] = entry.get("failures", 0) + 1
+                entry["consecutive_failures"] = (
+                    entry.get("consecutive_failures", 0) + 1
+                )
+
+    # Merge our statistics (if any changed) into those saved by other
+    # processes.
+    def save(self):
+        if not self._dirty:
+            return
+
+        with contextlib.suppress(FileExistsError):
+            os.makedirs(os.path.dirname(self.path))
+
+        with self._stats_lock, open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            saved = {}
+            with contextlib.suppress(FileNotFoundError, ValueError):
+                with open(self.path, "r") as f:
+                    saved = json.load(f)
+            for url, entry in self.stats.items():
+                if entry.get("checked", 0) >= saved.get(url, {}).get("checked", 0):
+                    saved[url] = entry
+            write_atomically(self.path, json.dumps(saved, indent=2).encode())
+            self._dirty = False
+
+
+# A timed span of work.  `set` attaches arguments (byte counts, cache
+# outcomes, ...) that are only known once the work is under way.
+class Span:
+    __slots__ = ("tracer", "name", "category", "args", "start")
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = str(exc_value)
+        self.tracer.add(self, end)
+        return False
+
+
+# Records spans as Chrome trace events (viewable in `about:tracing` or
+# Perfetto), written out by `write`.
+class Tracer:
+    enabled = True
+
+    def __init__(self, path):
+        self.path = path
+        self.origin = time.perf_counter()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def span(self, name, category, **args):
+        return Span(self, name, category, args)
+
+    def add(self, span, end):
+        event = {
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            "ts": round((span.start - self.origin) * 1e6),
+            "dur": round((end - span.start) * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": span.args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def write(self):
+        metadata = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "args": {
+                    "name": "get_kodi_addon.py on {0}".format(os.uname().nodename)
+                },
+            }
+        ]
+        document = {"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}
+        write_atomically(os.path.abspath(self.path), json.dumps(document).encode())
+        logging.info("Wrote trace '{0}'".format(self.path))
+
+
+# Wraps a stream, counting the bytes read from it and the time spent reading.
+class TimedReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.stream.read(size)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(data)
+        return data
+
+
+# What everything traces into unless `--trace` is given: a shared span that
+# does nothing, so that disabled tracing costs a method call per span.
+class NullSpan:
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullTracer:
+    enabled = False
+
+    _span = NullSpan()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def span(self, name, category, **args):
+        return self._span
+
+    def write(self):
+        pass
+
+
+# Feeds the same spans to several tracers (say, a trace file and metrics).
+class TracerGroup:
+    enabled = True
+
+    def __init__(self, tracers):
+        self.tracers = list(tracers)
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def span(self, name, category, **args):
+        return Span(self, name, category, args)
+
+    def add(self, span, end):
+        for tracer in self.tracers:
+            tracer.add(span, end)
+
+    def write(self):
+        for tracer in self.tracers:
+            tracer.write()
+
+
+# Aggregates spans into Prometheus metrics, written for node_exporter's
+# textfile collector.  Counters accumulate across runs: each write adds to
+# the counters of the previous file.  Gauges describe the latest run.
+class Metrics:
+    FILENAME = "kodi_addons.prom"
+
+    PREFIX = "kodi_addons_"
+
+    FAMILIES = {
+        "downloads_total": (
+            "counter",
+            "Downloads (including revalidations) by repository, mirror and result.",
+        ),
+        "download_bytes_total": (
+            "counter",
+            "Bytes downloaded by repository and mirror.",
+        ),
+        "download_duration_seconds_total": (
+            "counter",
+            "Time spent downloading, by repository and mirror.",
+        ),
+        "cache_requests_total": (
+            "counter",
+            "Cache lookups by kind of package and result (hit, verified, not-modified or miss).",
+        ),
+        "failures_total": (
+            "counter",
+            "Addons that failed to install, by reason.",
+        ),
+        "cache_hit_ratio": (
+            "gauge",
+            "Share of cache lookups in the last run that downloaded nothing, by kind of package.",
+        ),
+        "addon_install_duration_seconds": (
+            "gauge",
+            "Time taken to download and extract each addon in the last run.",
+        ),
+        "catalog_parse_duration_seconds": (
+            "gauge",
+            "Time taken to parse (or load the compiled) repository catalog in the last run.",
+        ),
+        "last_run_duration_seconds": ("gauge", "Duration of the last run."),
+        "last_run_success": ("gauge", "Whether the last run succeeded."),
+        "last_run_timestamp_seconds": ("gauge", "When the last run ended."),
+    }
+
+    # Cache results for which nothing was downloaded.
+    CACHE_HITS = ("hit", "verified", "not-modified")
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.counters = {}
+        self.gauges = {}
+        self.cache_results = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.FILENAME)
+
+    def span(self, name, category, **args):
+        return Span(self, name, category, args)
+
+    def count(self, name, labels, value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, span, end):
+        args = span.args
+        seconds = end - span.start
+
+        with self._lock:
+            if span.name == "download":
+                if "cache" in args:
+                    self.cache_results[span.category, args["cache"]] += 1
+                    self.count(
+                        "cache_requests_total",
+                        (("kind", span.category), ("result", args["cache"])),
+                    )
+                # Fresh cached copies involve no server.
+                if args.get("cache") == "hit":
+                    return
+                labels = (
+                    ("repository", args.get("repository", "")),
+                    ("mirror", args.get("mirror", "")),
+                )
+                result = "error" if "error" in args else "ok"
+                self.count("downloads_total", labels + (("result", result),))
+                self.count("download_bytes_total", labels, args.get("bytes", 0))
+                self.count("download_duration_seconds_total", labels, seconds)
+            elif span.name == "fetch addon" and "error" not in args:
+                self.gauges[
+                    "addon_install_duration_seconds", (("addon", args["addon"]),)
+                ] = seconds
+            elif span.name == "parse catalog" or (
+                span.name == "load compiled catalog" and args.get("cache") == "hit"
+            ):
+                source = "xml" if span.name == "parse catalog" else "compiled"
+                self.gauges[
+                    "catalog_parse_duration_seconds",
+                    (("repository", args["repository"]), ("source", source)),
+                ] = seconds
+            elif span.name == "install":
+                failures = args.get("failures") or {}
+                if not failures and "error" in args:
+                    failures = {"error": 1}
+                for reason, n in failures.items():
+                    self.count("failures_total", (("reason", reason),), n)
+                self.gauges["last_run_duration_seconds", ()] = seconds
+                self.gauges["last_run_success", ()] = int("error" not in args)
+                self.gauges["last_run_timestamp_seconds", ()] = time.time()
+
+    @classmethod
+    def series(cls, name, labels):
+        if not labels:
+            return cls.PREFIX + name
+        return "{0}{1}{{{2}}}".format(
+            cls.PREFIX,
+            name,
+            ",".join(
+                '{0}="{1}"'.format(
+                    label,
+                    str(value)
+                    .replace("\\", "\\\\")
+                    .replace('"', '\\"')
+                    .replace("\n", "\\n"),
+                )
+                for label, value in labels
+            ),
+        )
+
+    # The counter samples of the previous file, by series.
+    def previous_counters(self):
+        counters = {}
+        with contextlib.suppress(FileNotFoundError):
+            with open(self.path, "r") as f:
+                for line in f:
+                    if line.startswith("#") or not line.strip():
+                        continue
+                    series, value = line.rstrip("\n").rsplit(" ", 1)
+                    name = series.split("{", 1)[0][len(self.PREFIX) :]
+                    if self.FAMILIES.get(name, (None,))[0] == "counter":
+                        with contextlib.suppress(ValueError):
+                            counters[series] = (name, float(value))
+        return counters
+
+    def write(self):
+        with self._lock:
+            samples = {name: {} for name in self.FAMILIES}
+            totals, hits = collections.Counter(), collections.Counter()
+            for (kind, result), n in self.cache_results.items():
+                totals[kind] += n
+                if result in self.CACHE_HITS:
+                    hits[kind] += n
+            for kind, total in totals.items():
+                samples["cache_hit_ratio"][
+                    self.series("cache_hit_ratio", (("kind", kind),))
+                ] = hits[kind] / total
+
+            previous = self.previous_counters()
+            for (name, labels), value in self.counters.items():
+                series = self.series(name, labels)
+                samples[name][series] = value + previous.pop(series, (name, 0))[1]
+            for series, (name, value) in previous.items():
+                samples[name][series] = value
+            for (name, labels), value in self.gauges.items():
+                samples[name][self.series(name, labels)] = value
+
+        lines = []
+        for name, (kind, help) in self.FAMILIES.items():
+            if not samples[name]:
+                continue
+            lines.append("# HELP {0}{1} {2}".format(self.PREFIX, name, help))
+            lines.append("# TYPE {0}{1} {2}".format(self.PREFIX, name, kind))
+            for series, value in sorted(samples[name].items()):
+                lines.append("{0} {1}".format(series, repr(float(value))))
+
+        with contextlib.suppress(FileExistsError):
+            os.makedirs(self.directory)
+        # Readable by node_exporter, whatever user it runs as.
+        write_atomically(self.path, ("\n".join(lines) + "\n").encode(), mode=0o644)
+        logging.info("Wrote metrics '{0}'".format(self.path))
 
 
 class Propagatable:
@@ -190,12 +1475,27 @@ class Propagatable:
 
 
 class FilesystemMixin(Propagatable):
-    __propagated_attributes__ = set(["data_dir", "cache_dir"])
+    CACHE_TTL_DEFAULT = 3600
+
+    INSTALL_MODE_DEFAULT = "extract"
+
+    # `extract` unzips each package into the addons directory.  The others
+    # extract packages into the package store once, then populate addon
+    # directories from there.
+    INSTALL_MODES = ["extract", *PackageStore.MATERIALIZERS]
 
-    def __init__(self, data_dir=None, cache_dir=None, **kwargs):
+    __propagated_attributes__ = set(
+        ["data_dir", "cache_dir", "cache_ttl", "install_mode"]
+    )
+
+    def __init__(
+        self, data_dir=None, cache_dir=None, cache_ttl=None, install_mode=None, **kwargs
+    ):
         super().__init__(**kwargs)
         self.data_dir = data_dir
         self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.install_mode = install_mode
 
     @property
     def data_dir(self):
@@ -233,18 +1533,58 @@ class FilesystemMixin(Propagatable):
         if new_cache_dir is not None:
             self._cache_dir = os.path.expanduser(new_cache_dir)
 
+    # Number of seconds for which a cached download is used without checking
+    # back with the server.
+    @property
+    def cache_ttl(self):
+        with contextlib.suppress(AttributeError):
+            if self._cache_ttl is not None:
+                return self._cache_ttl
 
-class KodiConfigMixin(Propagatable):
-    KODI_USER_DEFAULT = "kodi"
+        self._cache_ttl = self.CACHE_TTL_DEFAULT
+        return self._cache_ttl
 
-    __propagated_attributes__ = set(
-        ["kodi_version", "kodi_user", "kodi_send_host", "kodi_send_port"]
-    )
+    @cache_ttl.setter
+    def cache_ttl(self, new_cache_ttl):
+        if new_cache_ttl is not None:
+            self._cache_ttl = int(new_cache_ttl)
 
-    def __init__(
-        self,
-        kodi_version=None,
-        kodi_user=None,
+    @property
+    def store_dir(self):
+        return os.path.join(self.cache_dir, "store")
+
+    @property
+    def install_mode(self):
+        with contextlib.suppress(AttributeError):
+            if self._install_mode is not None:
+                return self._install_mode
+
+        self._install_mode = self.INSTALL_MODE_DEFAULT
+        return self._install_mode
+
+    @install_mode.setter
+    def install_mode(self, new_install_mode):
+        if new_install_mode is not None:
+            if new_install_mode not in self.INSTALL_MODES:
+                raise ValueError(
+                    "unknown install mode '{0}'; expected one of {1}".format(
+                        new_install_mode, ", ".join(self.INSTALL_MODES)
+                    )
+                )
+            self._install_mode = new_install_mode
+
+
+class KodiConfigMixin(Propagatable):
+    KODI_USER_DEFAULT = "kodi"
+
+    __propagated_attributes__ = set(
+        ["kodi_version", "kodi_user", "kodi_send_host", "kodi_send_port"]
+    )
+
+    def __init__(
+        self,
+        kodi_version=None,
+        kodi_user=None,
         kodi_send_host=None,
         kodi_send_port=None,
         **kwargs,
@@ -302,7 +1642,115 @@ class KodiConfigMixin(Propagatable):
         self._kodi_send_port = new_kodi_send_port
 
 
-class PackageMixin(FilesystemMixin, KodiConfigMixin, abc.ABC):
+class IOMixin(Propagatable):
+    IO_BACKEND_DEFAULT = "native"
+
+    __propagated_attributes__ = set(
+        ["io_backend", "offline", "mirrors", "tracer", "upstream_cache"]
+    )
+
+    def __init__(
+        self,
+        io_backend=None,
+        offline=False,
+        mirrors=None,
+        tracer=None,
+        upstream_cache=None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.io_backend = io_backend
+        self.offline = offline
+        self.mirrors = mirrors
+        self.tracer = tracer
+        self.upstream_cache = upstream_cache
+
+    # When offline, cached files are used regardless of their age, and
+    # anything not cached is an error.
+    @property
+    def offline(self):
+        return self._offline
+
+    @offline.setter
+    def offline(self, new_offline):
+        self._offline = bool(new_offline)
+
+    # Accepts a backend name or instance.  Instances propagate, so that
+    # everything a `Manager` creates shares one connection pool.
+    @property
+    def io_backend(self):
+        with contextlib.suppress(AttributeError):
+            if self._io_backend is not None:
+                return self._io_backend
+
+        self.io_backend = self.IO_BACKEND_DEFAULT
+        return self._io_backend
+
+    @io_backend.setter
+    def io_backend(self, new_io_backend):
+        if isinstance(new_io_backend, str):
+            try:
+                new_io_backend = IO_BACKENDS[new_io_backend]()
+            except KeyError:
+                raise ValueError(
+                    "unknown I/O backend '{0}'; expected one of {1}".format(
+                        new_io_backend, ", ".join(sorted(IO_BACKENDS))
+                    )
+                )
+        if new_io_backend is not None:
+            self._io_backend = new_io_backend
+
+    # Shared, like the I/O backend, by everything a `Manager` creates.  Only
+    # meaningful in combination with `FilesystemMixin`, which supplies the
+    # cache directory and TTL.
+    @property
+    def mirrors(self):
+        with contextlib.suppress(AttributeError):
+            if self._mirrors is not None:
+                return self._mirrors
+
+        self._mirrors = MirrorSelector(
+            os.path.join(self.cache_dir, "mirrors.json"),
+            self.io_backend,
+            self.cache_ttl,
+        )
+        return self._mirrors
+
+    @mirrors.setter
+    def mirrors(self, new_mirrors):
+        if new_mirrors is not None:
+            self._mirrors = new_mirrors
+
+    # Accepts a trace file name or tracer instance; shared like the mirrors.
+    @property
+    def tracer(self):
+        with contextlib.suppress(AttributeError):
+            if self._tracer is not None:
+                return self._tracer
+
+        self._tracer = NullTracer()
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, new_tracer):
+        if isinstance(new_tracer, str):
+            new_tracer = Tracer(new_tracer)
+        if new_tracer is not None:
+            self._tracer = new_tracer
+
+    # The base URL of a `serve-cache` instance to download through, if any.
+    @property
+    def upstream_cache(self):
+        return self._upstream_cache
+
+    @upstream_cache.setter
+    def upstream_cache(self, new_upstream_cache):
+        self._upstream_cache = (
+            new_upstream_cache.rstrip("/") if new_upstream_cache else None
+        )
+
+
+class PackageMixin(FilesystemMixin, KodiConfigMixin, IOMixin, abc.ABC):
     def __init__(self, url=None, **kwargs):
         super().__init__(**kwargs)
         self.url = url
@@ -345,39 +1793,270 @@ class PackageMixin(FilesystemMixin, KodiConfigMixin, abc.ABC):
         ext = os.path.splitext(basename)[-1]
         output = os.path.join(destdir, "{0}{1}".format(h.hexdigest(), ext))
 
-        return (output, full + ["-o", output])
+        return (output, full)
+
+    # A (kind, digest) pair that the package must match, from a bundle or
+    # lockfile; it takes the place of the published checksum.
+    @property
+    def checksum(self):
+        with contextlib.suppress(AttributeError):
+            return self._checksum
+
+        return None
+
+    @checksum.setter
+    def checksum(self, new_checksum):
+        self._checksum = new_checksum
+
+    # Both backends use the `curl`-derived cache file name, so switching
+    # backends does not invalidate the cache.
+    @property
+    def cache_target(self):
+        target, _ = self.curl_into_cmd(
+            self.url, self.cache_dir, *SubprocessIO.CURL_ARGS
+        )
+        return target
+
+    # Validators key for a digest that was computed here rather than matched
+    # against a published checksum; it makes nothing `verified`.
+    COMPUTED_SHA256 = "computed-sha256"
+
+    # The SHA-256 checksum of the cached package, if there is one.
+    def cached_checksum(self):
+        target = self.cache_target
+        if not os.path.isfile(target):
+            return None
+
+        validators = read_validators(target)
+        for key in ("sha256", self.COMPUTED_SHA256):
+            if key in validators:
+                return "sha256", validators[key]
+
+        validators[self.COMPUTED_SHA256] = file_digest(target, h=hashlib.sha256())
+        write_validators(target, validators)
+        return "sha256", validators[self.COMPUTED_SHA256]
+
+    # Whether the file returned by `get` matched a published checksum (when
+    # it was downloaded or revalidated), which makes further checks of its
+    # content unnecessary.
+    @property
+    def verified(self):
+        with contextlib.suppress(AttributeError):
+            return self._verified
+
+        return False
+
+    # Checksum file kinds to look for next to `url`, in order of preference.
+    def checksum_kinds(self):
+        return list(CHECKSUM_KINDS)
+
+    # Download `url` through the upstream cache, if there is one, falling
+    # back to `url` itself if the cache cannot deliver it.  A 404 from the
+    # cache is the origin's, and final.
+    def download(self, url, output, **kwargs):
+        if self.upstream_cache is not None:
+            cached_url = "{0}/fetch?url={1}".format(
+                self.upstream_cache, urllib.parse.quote(url, safe="")
+            )
+            try:
+                return self.io_backend.download(
+                    cached_url, output, **{**kwargs, "retry": False}
+                )
+            except Exception as e:
+                if isinstance(e, _HTTPStatusError) and e.status == 404:
+                    raise
+                logging.warning(
+                    "Upstream cache failed to deliver '{0}' ({1}); downloading it directly".format(
+                        url, e
+                    )
+                )
+
+        return self.io_backend.download(url, output, **kwargs)
+
+    # Called with the kind of checksum file found next to `url`, or None.
+    def found_checksum_kind(self, kind):
+        pass
+
+    # Fetch the checksum published for `url`, as a (kind, digest) pair, or
+    # None if there is none.  Checksum files are often missing, so the first
+    # attempt is a single one; other failures are then retried like any other
+    # download.  Only when every kind is missing (404) is the lack of a
+    # checksum reported to `found_checksum_kind`, so that a transient error
+    # does not turn verification off for later packages.
+    def published_checksum(self, target):
+        if self.checksum is not None:
+            return self.checksum
+
+        missing = True
+        for kind in self.checksum_kinds():
+            url = "{0}.{1}".format(self.url, kind)
+            sidecar = "{0}.{1}.part".format(target, kind)
+            headers = {"User-Agent": self.user_agent}
+            try:
+                try:
+                    self.download(url, sidecar, headers=headers, retry=False)
+                except Exception as e:
+                    if isinstance(e, _HTTPStatusError) and e.status == 404:
+                        raise
+                    self.download(url, sidecar, headers=headers)
+                with open(sidecar, "r", errors="replace") as f:
+                    digest = parse_checksum(kind, f.read())
+            except _HTTPStatusError as e:
+                if e.status != 404:
+                    missing = False
+                logging.info("No checksum at '{0}' ({1})".format(url, e))
+                continue
+            except Exception as e:
+                missing = False
+                logging.info("No checksum at '{0}' ({1})".format(url, e))
+                continue
+            finally:
+                remove_partial(sidecar)
+
+            self.found_checksum_kind(kind)
+            return kind, digest
+
+        if missing:
+            self.found_checksum_kind(None)
+        return None
+
+    # Arguments identifying this package in trace spans (and metrics).
+    def trace_args(self):
+        return {"url": self.url, "mirror": self.url.rsplit("/", 1)[0]}
 
     def get(self):
+        with self.tracer.span(
+            "download", type(self).__name__.lower(), **self.trace_args()
+        ) as span:
+            return self._get(span)
+
+    # `get`, recording whether the cache was used ("hit": fresh; "verified":
+    # stale, but matching the published checksum; "not-modified": stale, but
+    # unchanged on the server; "miss": downloaded) and the bytes downloaded.
+    def _get(self, span):
         logging.info(
             "Fetching '{0}' into directory '{1}'".format(self.url, self.cache_dir)
         )
 
-        target, cmd = self.curl_into_cmd(
-            self.url,
-            self.cache_dir,
-            "-f",
-            "-s",
-            "-L",
-            "-S",
-            "--retry",
-            "5",
-            "--retry-all-errors",
-        )
+        target = self.cache_target
 
         try:
             mtime = os.path.getmtime(target)
         except Exception:
             mtime = 0
 
-        # Redownload if older than an hour
-        if not os.path.isfile(target) or ((time.time() - mtime) > 3600):
-            with contextlib.suppress(Exception):
-                rmtree(target)
-            curl(*cmd).check_returncode()
+        validators = read_validators(target) if os.path.isfile(target) else {}
+
+        if os.path.isfile(target) and (
+            self.offline or ((time.time() - mtime) <= self.cache_ttl)
+        ):
+            self._verified = any(kind in validators for kind in CHECKSUM_KINDS)
+            span.set(cache="hit", bytes=0)
+            return target
+
+        if self.offline:
+            raise Exception(
+                "'{0}' is not cached, and downloading is disabled".format(self.url)
+            )
+
+        # If the cached copy matches the published checksum, it is current;
+        # fetching the checksum is cheaper than revalidating the file, and
+        # works the same across redirecting mirrors with differing ETags.
+        published = self.published_checksum(target)
+        if published is not None and os.path.isfile(target):
+            kind, digest = published
+            if kind not in validators:
+                validators[kind] = file_digest(target, h=hashlib.new(kind))
+            if validators[kind] == digest:
+                logging.info(
+                    "'{0}' matches its published {1} checksum; reusing '{2}'".format(
+                        self.url, kind, target
+                    )
+                )
+                write_validators(target, validators)
+                os.utime(target)
+                self._verified = True
+                span.set(cache="verified", bytes=0)
+                return target
+
+            # Changed; revalidating would only risk a stale 304.
+            validators = {}
+
+        # Revalidate (or download for the first time).  Download into a
+        # separate file so that a failed transfer, or a 304 response, leaves
+        # the cached copy intact.  A failed transfer leaves the partial file
+        # behind, and the next attempt resumes it.
+        partial = "{0}.part".format(target)
+        headers = {"User-Agent": self.user_agent}
+        resumed = os.path.getsize(partial) if os.path.isfile(partial) else 0
+
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "last-modified" in validators:
+            headers["If-Modified-Since"] = validators["last-modified"]
+
+        status, response_headers, digest = self.download(
+            self.url,
+            partial,
+            headers=headers,
+            resume=True,
+            # Without a published checksum, keep a digest for
+            # `cached_checksum` (and so for plans) instead.
+            hash_name="sha256" if published is None else published[0],
+        )
+
+        if status == 304:
+            logging.info("'{0}' is unchanged; reusing '{1}'".format(self.url, target))
+            remove_partial(partial)
+            os.utime(target)
+            self._verified = any(kind in validators for kind in CHECKSUM_KINDS)
+            span.set(cache="not-modified", bytes=0)
+        else:
+            assert os.path.isfile(
+                partial
+            ), "downloading '{0}' failed to produce file '{1}'".format(
+                self.url, partial
+            )
+
+            # Only promote complete downloads; a short file is kept to be
+            # resumed.
+            span.set(
+                cache="miss",
+                bytes=os.path.getsize(partial) - (resumed if status == 206 else 0),
+            )
+            size = expected_size(status, response_headers)
+            if size is not None and os.path.getsize(partial) != size:
+                raise Exception(
+                    "downloading '{0}' produced {1} bytes rather than {2}".format(
+                        self.url, os.path.getsize(partial), size
+                    )
+                )
+
+            validators = response_validators(response_headers)
+            if published is not None:
+                kind, expected = published
+                if digest != expected:
+                    remove_partial(partial)
+                    raise Exception(
+                        "{0} checksum of '{1}' is {2} rather than the published {3}".format(
+                            kind, self.url, digest, expected
+                        )
+                    )
+                logging.info(
+                    "'{0}' matches its published {1} checksum".format(self.url, kind)
+                )
+                validators[kind] = digest
+            else:
+                validators[self.COMPUTED_SHA256] = digest
+
+            os.replace(partial, target)
+            remove_partial(partial)
+            write_validators(target, validators)
+            self._verified = published is not None
 
         assert os.path.isfile(
             target
-        ), "command '{0}' failed to produce file '{1}'".format(shlex.join(cmd), target)
+        ), "downloading '{0}' failed to produce file '{1}'".format(self.url, target)
 
         return target
 
@@ -488,7 +2167,7 @@ class Addon(PackageMixin, DocumentMixin, SpecifierMixin):
     @version.setter
     def version(self, new_version):
         if new_version is not None:
-            self._version = V(new_version)
+            self._version = parse_version(new_version)
 
     def imports(self):
         return self.findall(".//requires/import")
@@ -501,6 +2180,17 @@ class Addon(PackageMixin, DocumentMixin, SpecifierMixin):
     @baseurl.setter
     def baseurl(self, new_baseurl):
         self._baseurl = new_baseurl
+        self._url_missing = False
+
+    # The name of the repository whose catalog listed this addon, if any.
+    @property
+    def repository_name(self):
+        with contextlib.suppress(AttributeError):
+            return self._repository_name
+
+    @repository_name.setter
+    def repository_name(self, new_repository_name):
+        self._repository_name = new_repository_name
 
     @property
     def url(self):
@@ -508,12 +2198,18 @@ class Addon(PackageMixin, DocumentMixin, SpecifierMixin):
             if self._url is not None:
                 return self._url
 
+        # Remember that there is nothing to infer the URL from (until a base
+        # URL is set), so that checking for a URL only warns once.
         if self.baseurl is None:
+            with contextlib.suppress(AttributeError):
+                if self._url_missing:
+                    return None
             logging.warning(
                 "No base URL for '{0}'; cannot infer full addon package URL".format(
                     self.id
                 )
             )
+            self._url_missing = True
             return None
 
         if self.version is None:
@@ -531,6 +2227,30 @@ class Addon(PackageMixin, DocumentMixin, SpecifierMixin):
     def url(self, new_url):
         self._url = new_url
 
+    # The kind of checksum file (or None) that each datadir publishes next to
+    # its packages, as learnt from the first package fetched from it, so that
+    # later packages skip looking for the missing kinds.
+    _datadir_checksum_kinds = {}
+
+    def checksum_kinds(self):
+        with contextlib.suppress(KeyError):
+            kind = self._datadir_checksum_kinds[self.baseurl]
+            return [] if kind is None else [kind]
+
+        return super().checksum_kinds()
+
+    def found_checksum_kind(self, kind):
+        if self.baseurl is not None:
+            self._datadir_checksum_kinds.setdefault(self.baseurl, kind)
+
+    def trace_args(self):
+        args = {**super().trace_args(), "addon": self.id}
+        if self.repository_name is not None:
+            args["repository"] = self.repository_name
+        if self.baseurl is not None:
+            args["mirror"] = self.baseurl
+        return args
+
     @property
     def dir(self):
         return os.path.join(self.addons_dir, self.id)
@@ -542,6 +2262,27 @@ class Addon(PackageMixin, DocumentMixin, SpecifierMixin):
     def installed(self):
         return os.path.isdir(self.dir) and os.path.isfile(self.file)
 
+    # Only reads as far as the root element's start tag.
+    def installed_version(self):
+        if not self.installed():
+            return None
+
+        with contextlib.suppress(ET.ParseError):
+            for _, elt in ET.iterparse(self.file, events=("start",)):
+                return elt.attrib.get("version")
+
+    # Versions that are not PEP 440 (or a corrupt `addon.xml`) can only be
+    # compared for equality.
+    def up_to_date(self):
+        installed_version = self.installed_version()
+        if installed_version is None or self.version is None:
+            return False
+
+        try:
+            return V(installed_version) >= V(str(self.version))
+        except InvalidVersion:
+            return installed_version == str(self.version)
+
     def each_dependency(self, **kwargs):
         all_kwargs = self.resolve_propagated_attributes(self)
         all_kwargs.update(kwargs)
@@ -553,13 +2294,38 @@ class Addon(PackageMixin, DocumentMixin, SpecifierMixin):
             )
 
     def extract(self, source):
-        logging.info("Checking that '{0}' is a zip file".format(source))
-        looks_like_zip(source).check_returncode()
+        with self.tracer.span(
+            "extract",
+            "addon",
+            addon=self.id,
+            bytes=os.path.getsize(source),
+            install_mode=self.install_mode,
+        ):
+            self._extract(source)
 
-        logging.info(
-            "Unzipping '{0}' into the parent of '{1}'".format(source, self.dir)
-        )
-        unzip_to_dir(os.path.dirname(self.dir), source)
+        # Forget any previously-parsed `addon.xml`.
+        self._data = None
+
+        return source
+
+    def _extract(self, source):
+        if self.install_mode == "extract":
+            logging.info(
+                "Extracting '{0}' into the parent of '{1}'".format(source, self.dir)
+            )
+            self.io_backend.extract_zip(
+                source, os.path.dirname(self.dir), verified=self.verified
+            )
+        else:
+            store = PackageStore(self.store_dir, self.io_backend)
+            with store.in_use():
+                digest = store.add(source, verified=self.verified)
+                logging.info(
+                    "Materializing '{0}' from package store into '{1}' ({2})".format(
+                        self.id, self.dir, self.install_mode
+                    )
+                )
+                store.materialize(digest, self.id, self.dir, self.install_mode)
 
         assert (
             self.installed()
@@ -567,10 +2333,169 @@ class Addon(PackageMixin, DocumentMixin, SpecifierMixin):
             self.id, self.dir, source
         )
 
-        return source
 
+CatalogImport = collections.namedtuple("CatalogImport", ["addon", "version"])
+
+CatalogEntry = collections.namedtuple(
+    "CatalogEntry", ["id", "version", "imports", "datadirs"]
+)
+
+
+# An index over a repository's `addons.xml`, built in a single pass, that maps
+# each addon ID to its available versions (highest first) together with the
+# only bits of metadata we care about: imports and datadirs.
+class Catalog:
+    # Bump this whenever the compiled (marshalled) representation changes.
+    COMPILED_FORMAT = 2
+
+    # `mirrors` maps the catalog (`<info>`) URLs of the repository addons in
+    # the catalog to the datadirs declared next to them.
+    def __init__(self, entries=(), datadirs=(), mirrors=None, presorted=False):
+        self.addons = {}
+        self.datadirs = list(datadirs)
+        self.mirrors = dict(mirrors or {})
+
+        for entry in entries:
+            self.addons.setdefault(entry.id, []).append(entry)
+
+        if not presorted:
+            for versions in self.addons.values():
+                versions.sort(key=self.version_key, reverse=True)
+
+    # Repositories list versions that are not valid PEP 440 (say, Kodi-style
+    # `2.0.0~beta1`); those sort below all valid versions of the addon,
+    # rather than breaking the whole catalog.
+    @staticmethod
+    def version_key(entry):
+        try:
+            return (1, V(entry.version), entry.version)
+        except InvalidVersion:
+            return (0, None, entry.version)
+
+    @classmethod
+    def entry_from_element(cls, elt):
+        return CatalogEntry(
+            elt.attrib["id"],
+            elt.attrib.get("version", "0.0.0"),
+            tuple(
+                CatalogImport(imp.attrib["addon"], imp.attrib.get("version", None))
+                for imp in elt.findall("./requires/import")
+            ),
+            tuple(datadir.text for datadir in elt.iter("datadir")),
+        )
+
+    # Build a catalog from a (possibly huge) `addons.xml` stream, holding only
+    # one `<addon>` element in memory at a time.
+    @classmethod
+    def from_stream(cls, stream):
+        entries = []
+        datadirs = []
+        mirrors = {}
+        root = None
+
+        for event, elt in ET.iterparse(stream, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elt
+                continue
+
+            if elt.tag == "datadir":
+                datadirs.append(elt.text)
+            elif elt.tag in ("dir", "extension") and elt.find("info") is not None:
+                info = elt.find("info").text
+                mirrors.setdefault(info, []).extend(
+                    datadir.text for datadir in elt.findall("datadir")
+                )
+            elif elt.tag == "addon":
+                entries.append(cls.entry_from_element(elt))
+                elt.clear()
+                # Also drop the (now empty) element from its parent.
+                if elt is not root:
+                    root.clear()
+
+        return cls(entries=entries, datadirs=datadirs, mirrors=mirrors)
+
+    def __contains__(self, addon_id):
+        return addon_id in self.addons
+
+    def __len__(self):
+        return len(self.addons)
+
+    # Compiled catalogs are plain tuples of builtins, so that `marshal` can
+    # handle them and loading them involves no XML parsing or version sorting.
+    # `key` identifies the source document; a compiled catalog whose key does
+    # not match is stale.
+    def dump(self, path, key):
+        entries = tuple(
+            (
+                entry.id,
+                entry.version,
+                tuple(tuple(imp) for imp in entry.imports),
+                entry.datadirs,
+            )
+            for versions in self.addons.values()
+            for entry in versions
+        )
+
+        write_atomically(
+            path,
+            marshal.dumps(
+                (
+                    self.COMPILED_FORMAT,
+                    key,
+                    entries,
+                    tuple(self.datadirs),
+                    tuple(
+                        (info, tuple(datadirs))
+                        for info, datadirs in self.mirrors.items()
+                    ),
+                )
+            ),
+        )
+
+    @classmethod
+    def load(cls, path, key):
+        try:
+            with open(path, "rb") as f:
+                compiled = marshal.load(f)
+            compiled_format, compiled_key = compiled[:2]
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(
+                "Ignoring unreadable compiled catalog '{0}': {1}".format(path, e)
+            )
+            return None
+
+        if compiled_format != cls.COMPILED_FORMAT or compiled_key != key:
+            return None
+
+        _, _, entries, datadirs, mirrors = compiled
+
+        return cls(
+            entries=(
+                CatalogEntry(
+                    id,
+                    version,
+                    tuple(CatalogImport(*imp) for imp in imports),
+                    datadirs,
+                )
+                for id, version, imports, datadirs in entries
+            ),
+            datadirs=datadirs,
+            mirrors={info: list(datadirs) for info, datadirs in mirrors},
+            presorted=True,
+        )
+
+    def versions(self, addon_id):
+        return self.addons.get(addon_id, [])
+
+    def best(self, addon_id):
+        with contextlib.suppress(IndexError):
+            return self.versions(addon_id)[0]
 
-class Repository(PackageMixin, DocumentMixin, SpecifierMixin):
+
+class Repository(PackageMixin, SpecifierMixin):
     def __init__(self, name, **kwargs):
         super().__init__(**kwargs)
         self.name = name
@@ -600,37 +2525,136 @@ class Repository(PackageMixin, DocumentMixin, SpecifierMixin):
     def url(self, new_url):
         self._url = new_url
 
+    # The catalog is parsed straight from the downloaded (and possibly
+    # compressed) document; there is nothing to extract.
+    def extract(self, source):
+        return source
+
+    # Repositories publish an MD5 checksum of their catalog.
+    def checksum_kinds(self):
+        return ["md5"]
+
+    def trace_args(self):
+        return {**super().trace_args(), "repository": self.name}
+
     @property
-    def file(self):
-        return self.cache_file
+    def catalog(self):
+        with contextlib.suppress(AttributeError):
+            if self._catalog is not None:
+                return self._catalog
 
-    def extract(self, source):
-        with contextlib.suppress(subprocess.CalledProcessError):
-            noext, ext = os.path.splitext(source)
-            output = (source if ext == "" else noext) + os.path.extsep + "xml"
-            return gunzip_into(output, source)
+        # Remember failures too, so that a repository that could not be
+        # fetched while prefetching is not retried (with backoff) on first use.
+        with contextlib.suppress(AttributeError):
+            if self._catalog_error is not None:
+                raise self._catalog_error
 
-        return source
+        try:
+            self._catalog = self.load_catalog()
+        except Exception as e:
+            self._catalog_error = e
+            raise
+
+        return self._catalog
+
+    # The compiled catalog lives next to the downloaded document, under the
+    # same (URL-derived) name, and is keyed by the document's content hash.
+    # When the document is unchanged, this skips decompression and parsing.
+    # Offline, nothing is written: the document must be cached already, and
+    # the catalog is compiled in memory only.
+    def load_catalog(self):
+        if not self.offline:
+            with contextlib.suppress(FileExistsError):
+                os.makedirs(self.cache_dir)
+
+        source = self.get()
+        compiled = os.path.splitext(source)[0] + os.path.extsep + "catalog"
+
+        with self.tracer.span(
+            "load compiled catalog", "repository", repository=self.name
+        ) as span:
+            key = file_digest(source)
+            catalog = Catalog.load(compiled, key)
+            span.set(cache="miss" if catalog is None else "hit")
+        if catalog is not None:
+            logging.info(
+                "Using compiled catalog '{0}' for repository '{1}'".format(
+                    compiled, self.name
+                )
+            )
+            return catalog
+
+        self._cache_file = self.extract(source)
+        with self.tracer.span(
+            "parse catalog",
+            "repository",
+            repository=self.name,
+            compressed_bytes=os.path.getsize(source),
+        ) as span:
+            with self.io_backend.open_decompressed(source) as stream:
+                # Decompression is interleaved with parsing; when tracing,
+                # time it separately.
+                if self.tracer.enabled:
+                    stream = TimedReader(stream)
+                catalog = Catalog.from_stream(stream)
+            if self.tracer.enabled:
+                span.set(
+                    bytes=stream.bytes,
+                    decompress_seconds=round(stream.seconds, 6),
+                    addons=len(catalog),
+                )
+
+        if self.offline:
+            return catalog
+
+        logging.info(
+            "Writing compiled catalog '{0}' for repository '{1}'".format(
+                compiled, self.name
+            )
+        )
+        try:
+            catalog.dump(compiled, key)
+        except Exception as e:
+            logging.warning(
+                "Failed to write compiled catalog '{0}': {1}".format(compiled, e)
+            )
+
+        return catalog
 
     def addons_for_id(self, addon_id):
-        return self.findall(".//addon[@id='{0}']".format(addon_id))
+        return self.catalog.versions(addon_id)
 
     def addon_for_id(self, addon_id):
-        def _addon_version(elt):
-            return V(elt.attrib.get("version", "0.0.0"))
-
-        with contextlib.suppress(IndexError):
-            return sorted(
-                self.addons_for_id(addon_id), key=_addon_version, reverse=True
-            )[0]
+        return self.catalog.best(addon_id)
 
     def addon_imports(self, addon_id):
-        return self.matching_attribute(
-            ".//addon[@id='{0}']/requires/import".format(addon_id), "addon"
-        )
-
+        match = self.addon_for_id(addon_id)
+        if match is not None:
+            for imp in match.imports:
+                yield imp.addon
+
+    # The datadirs that the catalog declares for this repository (next to
+    # an `<info>` naming its URL); failing that, all the datadirs in the
+    # catalog except those of other repositories, whose mirrors would only
+    # be probed in vain.
     def each_datadir(self):
-        for datadir in self.matching_text(".//datadir"):
+        def catalog_url(url):
+            return url.strip().rsplit(".gz", 1)[0]
+
+        mirrors = self.catalog.mirrors
+        datadirs = [
+            datadir
+            for info, datadirs in mirrors.items()
+            if info is not None and catalog_url(info) == catalog_url(self.url)
+            for datadir in datadirs
+        ]
+        if datadirs == []:
+            foreign = {datadir for datadirs in mirrors.values() for datadir in datadirs}
+            datadirs = [
+                datadir for datadir in self.catalog.datadirs if datadir not in foreign
+            ]
+
+        for datadir in dict.fromkeys(datadirs):
             yield datadir
 
         # Try parent directory of repository URL.
@@ -645,10 +2669,42 @@ class Repository(PackageMixin, DocumentMixin, SpecifierMixin):
 
         yield datadir.geturl()
 
+    # `each_datadir`, fastest healthy mirror first; ranked once per run.
+    def ranked_datadirs(self):
+        with contextlib.suppress(AttributeError):
+            if self._ranked_datadirs is not None:
+                return self._ranked_datadirs
+
+        self._ranked_datadirs = self.mirrors.rank(
+            self.each_datadir(), offline=self.offline
+        )
+        if len(self._ranked_datadirs) > 1:
+            logging.info(
+                "Using mirrors for repository '{0}' in order {1}".format(
+                    self.name, ", ".join(self._ranked_datadirs)
+                )
+            )
+        return self._ranked_datadirs
+
+
+# Any file that `serve-cache` proxies.  It is cached under the same
+# URL-derived name as any other download, and verified against its published
+# checksum, if there is one.
+class CachedFile(PackageMixin):
+    def extract(self, source):
+        return source
+
+    # Checksum files have no checksums of their own.
+    def checksum_kinds(self):
+        if self.url.rsplit(".", 1)[-1] in CHECKSUM_KINDS:
+            return []
+        return super().checksum_kinds()
+
 
 class Database:
-    def __init__(self, path):
+    def __init__(self, path, tracer=None):
         self.path = path
+        self.tracer = NullTracer() if tracer is None else tracer
 
     @property
     def path(self):
@@ -658,10 +2714,50 @@ class Database:
     def path(self, new_path):
         self._path = new_path
 
+    # Use WAL journaling (which needs fewer fsyncs per commit) for the lifetime
+    # of this connection.  SQLite refuses the switch while other connections
+    # are open (e.g. a running Kodi), and `close` restores the original
+    # journal mode, so Kodi always finds the database the way it left it.
     def connect(self):
         with contextlib.suppress(FileExistsError):
             os.makedirs(os.path.dirname(self.path))
-        return sqlite3.connect(self.path)
+        connection = sqlite3.connect(self.path)
+
+        try:
+            (self._journal_mode,) = connection.execute("PRAGMA journal_mode").fetchone()
+            (journal_mode,) = connection.execute("PRAGMA journal_mode=WAL").fetchone()
+            if journal_mode.lower() == "wal":
+                connection.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.Error as e:
+            logging.info(
+                "Not using WAL journaling for '{0}': {1}".format(self.path, e)
+            )
+
+        return connection
+
+    def close(self):
+        with contextlib.suppress(AttributeError):
+            self.flush()
+
+            journal_mode = getattr(self, "_journal_mode", None)
+            if journal_mode is not None and journal_mode.lower() != "wal":
+                try:
+                    self._connection.execute(
+                        "PRAGMA journal_mode={0}".format(journal_mode)
+                    )
+                except sqlite3.Error as e:
+                    logging.warning(
+                        "Could not restore journal mode '{0}' for '{1}': {2}".format(
+                            journal_mode, self.path, e
+                        )
+                    )
+
+            self._connection.close()
+            del self._connection
+            with contextlib.suppress(AttributeError):
+                del self._cursor
+            with contextlib.suppress(AttributeError):
+                del self._installed
 
     @property
     def connection(self):
@@ -680,6 +2776,7 @@ class Database:
             return self._cursor
 
     def populate(self, database_version):
+        # One transaction for both the schema and the version row.
         self.cursor.executescript(
             """
             BEGIN;
@@ -700,35 +2797,81 @@ class Database:
             CREATE UNIQUE INDEX IF NOT EXISTS idxBlack ON blacklist(addonID);
             CREATE UNIQUE INDEX IF NOT EXISTS idxPackage ON package(filename);
 
+            INSERT INTO version (idVersion, iCompressCount) SELECT {0}, 0 WHERE (SELECT COUNT(*) FROM version) = 0;
+            UPDATE version SET idVersion = 33;
+
             COMMIT;
-        """
+        """.format(
+                int(database_version)
+            )
         )
 
+    # The `installed` table, loaded once: a mapping of addon ID to `enabled`.
+    # Kept up to date with our own (possibly not yet flushed) changes.
+    @property
+    def installed(self):
         try:
-            self.cursor.execute("BEGIN TRANSACTION")
-            self.cursor.execute(
-                """
-                INSERT INTO version (idVersion, iCompressCount) SELECT ?, 0 WHERE (SELECT COUNT(*) FROM version) = 0
-                """,
-                (database_version,),
-            )
-            self.cursor.execute("UPDATE version SET idVersion = 33")
-            self.connection.commit()
-        except sqlite3.Error as e:
-            self.connection.rollback()
-            raise (e)
+            return self._installed
+        except AttributeError:
+            res = self.cursor.execute("SELECT addonID, enabled FROM installed")
+            self._installed = dict(res.fetchall())
+            return self._installed
 
-    def upsert_installed(self, addon):
-        self.cursor.execute(
-            """
-            INSERT INTO installed (addonID, enabled, installDate)
-                VALUES (?, 1, datetime(0, "unixepoch"))
-                ON CONFLICT(addonID) DO UPDATE SET enabled=1
-            """,
-            (addon.id,),
-        )
+    @property
+    def pending(self):
+        try:
+            return self._pending
+        except AttributeError:
+            self._pending = []
+            return self._pending
 
-        self.connection.commit()
+    @property
+    def batching(self):
+        return getattr(self, "_batching", False)
+
+    # Defer `upsert_installed` writes until the end of the block, then apply
+    # all of them in a single transaction.
+    @contextlib.contextmanager
+    def batch(self):
+        self._batching = True
+        try:
+            yield self
+        finally:
+            self._batching = False
+            self.flush()
+
+    def flush(self):
+        pending, self._pending = self.pending, []
+        if pending:
+            self.upsert_installed_many(pending)
+
+    def upsert_installed_many(self, addon_ids):
+        try:
+            with self.tracer.span(
+                "write database", "database", addons=len(addon_ids)
+            ):
+                self.cursor.executemany(
+                    """
+                    INSERT INTO installed (addonID, enabled, installDate)
+                        VALUES (?, 1, datetime(0, "unixepoch"))
+                        ON CONFLICT(addonID) DO UPDATE SET enabled=1
+                    """,
+                    [(addon_id,) for addon_id in addon_ids],
+                )
+                self.connection.commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            raise (e)
+
+        for addon_id in addon_ids:
+            self.installed[addon_id] = 1
+
+    def upsert_installed(self, addon):
+        if self.batching:
+            self.pending.append(addon.id)
+            self.installed[addon.id] = 1
+        else:
+            self.upsert_installed_many([addon.id])
 
     def update_installed(self, addon):
         self.cursor.execute(
@@ -742,28 +2885,238 @@ class Database:
 
         self.connection.commit()
 
-    def addon_installed(self, addon):
-        res = self.cursor.execute(
-            """
-            SELECT 1 FROM installed WHERE addonID = ?
-            """,
-            (addon.id,),
-        )
+        if addon.id in self.installed:
+            self.installed[addon.id] = 1
 
-        return res.fetchone() is not None
+    def addon_installed(self, addon):
+        return addon.id in self.installed
 
     def addon_enabled(self, addon):
-        res = self.cursor.execute(
-            """
-            SELECT 1 FROM installed WHERE addonID = ? AND enabled = 1
-            """,
-            (addon.id,),
+        return self.installed.get(addon.id) == 1
+
+
+class DependencyNode:
+    def __init__(self, addon, candidates=(), core=False, error=None):
+        self.addon = addon
+        self.candidates = list(candidates)
+        self.core = core
+        self.error = error
+        # Why the addon failed: "catalog" (a repository catalog could not be
+        # loaded), "not-found", "fetch" (no candidate could be downloaded and
+        # extracted), "dependency" or "version" (a dependency's required
+        # version is not valid)
+        self.reason = None
+        # Dependency addon ID -> minimum version (or `None`)
+        self.dependencies = {}
+        # Set once the addon has been fetched
+        self.repository = None
+        self.candidate = None
+        # The root of the fetched package's `addon.xml`, where it was read
+        self.addon_xml = None
+        # Set once the addon's installation outcome is known
+        self.settled = False
+        self.outcome = None
+        self.marked = False
+
+    @property
+    def id(self):
+        return self.addon.id
+
+    @property
+    def version(self):
+        if self.candidate is not None:
+            return self.candidate.version
+        for _, candidate in self.candidates[:1]:
+            return candidate.version
+        return self.addon.version
+
+    @property
+    def source(self):
+        if self.candidate is not None:
+            return self.repository, self.candidate
+        for repository, candidate in self.candidates[:1]:
+            return repository, candidate
+        return None, None
+
+    @property
+    def fetchable(self):
+        return (
+            not self.core
+            and self.error is None
+            and self.candidate is None
+            and self.candidates != []
         )
 
-        return res.fetchone() is not None
+    # A malformed required version fails this addon, rather than the run.
+    def require(self, addon_id, version=None):
+        if version is not None:
+            try:
+                V(version)
+            except InvalidVersion:
+                if self.error is None:
+                    self.error = Exception(
+                        "Failed to install '{0}': invalid version '{1}' required for dependency '{2}'".format(
+                            self.id, version, addon_id
+                        )
+                    )
+                    self.reason = "version"
+                version = None
+
+        current = self.dependencies.get(addon_id)
+        if current is None or (version is not None and V(version) > V(current)):
+            self.dependencies[addon_id] = version
+
+    def to_json(self):
+        repository, candidate = self.source
+        installed_version = None if candidate is None else candidate.installed_version()
+        return {
+            "version": None if self.version is None else str(self.version),
+            "installed_version": installed_version,
+            "up_to_date": candidate is not None and candidate.up_to_date(),
+            "repository": None if repository is None else repository.name,
+            "url": None if candidate is None else candidate.url,
+            "core": self.core,
+            "error": None if self.error is None else str(self.error),
+            "dependencies": [
+                {"addon": addon_id, "version": version}
+                for addon_id, version in sorted(self.dependencies.items())
+            ],
+        }
+
+
+class DependencyGraph:
+    def __init__(self):
+        self.nodes = {}
+        self.requested = []
+
+    def __contains__(self, addon_id):
+        return addon_id in self.nodes
+
+    def __getitem__(self, addon_id):
+        return self.nodes[addon_id]
+
+    def add(self, node):
+        self.nodes[node.id] = node
+        return node
+
+    def edges(self, addon_id):
+        for dependency in sorted(self.nodes[addon_id].dependencies):
+            if dependency in self.nodes:
+                yield dependency
+
+    # Strongly-connected components (Tarjan), emitted dependencies-first:
+    # every component comes after all of the components it depends on.
+    def components(self):
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+
+        def _visit(addon_id):
+            index[addon_id] = lowlink[addon_id] = len(index)
+            stack.append(addon_id)
+            on_stack.add(addon_id)
+
+            for dependency in self.edges(addon_id):
+                if dependency not in index:
+                    _visit(dependency)
+                    lowlink[addon_id] = min(lowlink[addon_id], lowlink[dependency])
+                elif dependency in on_stack:
+                    lowlink[addon_id] = min(lowlink[addon_id], index[dependency])
+
+            if lowlink[addon_id] == index[addon_id]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == addon_id:
+                        break
+                components.append(sorted(component))
+
+        for addon_id in sorted(self.nodes):
+            if addon_id not in index:
+                _visit(addon_id)
+
+        return components
+
+    def cycles(self):
+        return [
+            component
+            for component in self.components()
+            if len(component) > 1 or component[0] in self.nodes[component[0]].dependencies
+        ]
+
+    # Topologically-ordered batches: every addon comes in a later level than
+    # all of its dependencies, except for members of the same cycle, which
+    # share a level.
+    def levels(self):
+        component_of = {}
+        level_of = {}
+        levels = []
+
+        for i, component in enumerate(self.components()):
+            for addon_id in component:
+                component_of[addon_id] = i
+
+            dependency_levels = [
+                level_of[component_of[dependency]]
+                for addon_id in component
+                for dependency in self.edges(addon_id)
+                if component_of[dependency] != i
+            ]
+            level_of[i] = 1 + max(dependency_levels, default=-1)
+
+            if level_of[i] == len(levels):
+                levels.append([])
+            levels[level_of[i]].extend(component)
+
+        return [sorted(level) for level in levels]
+
+    # Dependencies whose resolved version is older than the minimum version
+    # some addon requires.
+    def conflicts(self):
+        conflicts = []
+        for addon_id, node in sorted(self.nodes.items()):
+            for dependency, required in sorted(node.dependencies.items()):
+                if required is None or dependency not in self.nodes:
+                    continue
+                available = self.nodes[dependency].version
+                if self.nodes[dependency].core or available is None:
+                    continue
+                # Versions that are not PEP 440 cannot be ordered.
+                try:
+                    conflicting = V(str(available)) < V(required)
+                except InvalidVersion:
+                    continue
+                if conflicting:
+                    conflicts.append(
+                        {
+                            "addon": dependency,
+                            "required_by": addon_id,
+                            "required": required,
+                            "available": str(available),
+                        }
+                    )
+        return conflicts
+
+    def to_json(self):
+        return {
+            "addons": list(self.requested),
+            "nodes": {
+                addon_id: node.to_json() for addon_id, node in sorted(self.nodes.items())
+            },
+            "levels": self.levels(),
+            "cycles": self.cycles(),
+            "conflicts": self.conflicts(),
+            "missing": sorted(
+                addon_id for addon_id, node in self.nodes.items() if node.error is not None
+            ),
+        }
 
 
-class Manager(FilesystemMixin, KodiConfigMixin):
+class Manager(FilesystemMixin, KodiConfigMixin, IOMixin):
     KODI_CORE_ADDONS = set(("xbmc.addon", "xbmc.python"))
 
     def __init__(
@@ -771,12 +3124,53 @@ class Manager(FilesystemMixin, KodiConfigMixin):
         repositories=[],
         enabled_repositories=[],
         addons=[],
+        jobs=None,
+        lockfile=None,
+        locked=False,
         **kwargs,
     ):
         super().__init__(**kwargs)
         self.repositories = repositories
         self.enabled_repositories = enabled_repositories
         self.addons = addons
+        self.jobs = jobs
+        self.lockfile = lockfile
+        self.locked = locked
+
+    # The plan of the last successful `install`, from which `--locked`
+    # installs reproduce it without consulting the repositories.
+    @property
+    def lockfile(self):
+        with contextlib.suppress(AttributeError):
+            if self._lockfile is not None:
+                return self._lockfile
+
+        self._lockfile = os.path.join(self.cache_dir, "addons.lock.json")
+        return self._lockfile
+
+    @lockfile.setter
+    def lockfile(self, new_lockfile):
+        if new_lockfile is not None:
+            self._lockfile = os.path.expanduser(new_lockfile)
+
+    # Whether to install what the lockfile records, rather than resolving
+    # addons anew (and rewriting the lockfile).
+    @property
+    def locked(self):
+        return self._locked
+
+    @locked.setter
+    def locked(self, new_locked):
+        self._locked = bool(new_locked)
+
+    @property
+    def jobs(self):
+        return self._jobs
+
+    @jobs.setter
+    def jobs(self, new_jobs):
+        self._jobs = max(1, int(new_jobs)) if new_jobs is not None else 1
+        self.mirrors.jobs = self._jobs
 
     @property
     def addons(self):
@@ -891,7 +3285,7 @@ class Manager(FilesystemMixin, KodiConfigMixin):
             return self._handle
         except AttributeError:
             logging.info("Opening database at '{0}'".format(self.database))
-            self._handle = Database(self.database)
+            self._handle = Database(self.database, tracer=self.tracer)
             return self._handle
 
     def each_repository(self):
@@ -899,10 +3293,42 @@ class Manager(FilesystemMixin, KodiConfigMixin):
             if name in self.repositories:
                 yield self.repositories[name]
 
+    # Download and index all enabled repositories' catalogs concurrently, so
+    # that startup takes as long as the slowest repository rather than the sum
+    # of all of them.  Lookups still walk the repositories in priority order;
+    # failures are only logged here, and are raised again when the catalog is
+    # first used.
+    def prefetch_catalogs(self):
+        repositories = list(self.each_repository())
+        if len(repositories) < 2:
+            return
+
+        def prefetch(repository):
+            try:
+                repository.catalog
+            except Exception as e:
+                logging.warning(
+                    "Error prefetching catalog for repository '{0}': {1}".format(
+                        repository.name, e
+                    )
+                )
+
+        logging.info(
+            "Prefetching catalogs for repositories {0}".format(
+                ", ".join(repository.name for repository in repositories)
+            )
+        )
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(repositories)
+        ) as executor:
+            list(executor.map(prefetch, repositories))
+
     def each_addon_candidate(self, addon):
-        if addon.url is not None:
+        url = addon.url
+        if url is not None:
             logging.info(
-                "Using provided URL '{0}' for addon '{1}'".format(addon.url, addon.id)
+                "Using provided URL '{0}' for addon '{1}'".format(url, addon.id)
             )
             yield None, addon
         else:
@@ -917,10 +3343,11 @@ class Manager(FilesystemMixin, KodiConfigMixin):
                             addon.id, repository.name
                         )
                     )
-                    for datadir in repository.each_datadir():
+                    for datadir in repository.ranked_datadirs():
                         candidate = copy.deepcopy(addon)
-                        candidate.version = match.attrib["version"]
+                        candidate.version = match.version
                         candidate.baseurl = datadir
+                        candidate.repository_name = repository.name
                         yield repository, candidate
                 else:
                     logging.info(
@@ -930,154 +3357,674 @@ class Manager(FilesystemMixin, KodiConfigMixin):
     def addon_is_core(self, addon):
         return addon.id in self.KODI_CORE_ADDONS
 
-    def install_addon(self, addon, seen={}):
-        # Might get a plain old string
-        addon = self.parse_addon(addon)
+    PLAN_FORMAT = 1
 
-        if addon.id in seen:
-            logging.info("Already handled addon '{0}'".format(addon.id))
-            return
+    # Addon ID -> plan entry for addons whose version, URL and checksum are
+    # fixed by a bundle or lockfile; `resolve` uses these instead of the
+    # repositories.
+    @property
+    def pinned(self):
+        with contextlib.suppress(AttributeError):
+            return self._pinned
 
-        logging.info("Handling addon '{0}'".format(addon.id))
+        self._pinned = {}
+        return self._pinned
 
-        seen[addon.id] = True
+    def pin(self, plan):
+        if plan.get("format") != self.PLAN_FORMAT:
+            raise Exception(
+                "unsupported plan format {0}; expected {1}".format(
+                    plan.get("format"), self.PLAN_FORMAT
+                )
+            )
+        self.pinned.update(plan["packages"])
+
+    def pinned_addon(self, addon_id):
+        entry = self.pinned[addon_id]
+        addon = self.parse_addon("{0}={1}".format(addon_id, entry["url"]))
+        addon.version = entry["version"]
+        addon.checksum = checksum_from_str(entry["checksum"])
+        return addon
+
+    # Describe `graph` such that `pin` can reproduce it without consulting
+    # any repository: the exact versions, URLs and checksums of its addons.
+    def plan(self, graph):
+        packages = {}
+        for addon_id, node in sorted(graph.nodes.items()):
+            repository, candidate = node.source
+            if node.core or node.error is not None or candidate is None:
+                continue
+            packages[addon_id] = {
+                "version": None if node.version is None else str(node.version),
+                "url": candidate.url,
+                "repository": None if repository is None else repository.name,
+                "checksum": checksum_to_str(
+                    candidate.cached_checksum() or candidate.checksum
+                ),
+                "dependencies": dict(sorted(node.dependencies.items())),
+            }
 
-        if self.addon_is_core(addon):
-            logging.info("Skipping core addon '{0}'".format(addon.id))
-            return
-        else:
-            logging.info("'{0}' is not a core addon".format(addon.id))
+        return {
+            "format": self.PLAN_FORMAT,
+            "kodi_version": str(self.kodi_version),
+            **self.plan_repositories(),
+            "addons": list(graph.requested),
+            "core": sorted(addon_id for addon_id, node in graph.nodes.items() if node.core),
+            "packages": packages,
+        }
 
-        for repository, candidate in self.each_addon_candidate(addon):
-            try:
-                if self.handle.addon_installed(candidate) and False:
-                    if not candidate.installed():
-                        logging.warning(
-                            "'{0}' is marked as installed, but addon directory is absent".format(
-                                candidate.id
-                            )
-                        )
+    # The repositories a plan was resolved against.
+    def plan_repositories(self):
+        return {
+            "repositories": {
+                name: repository.url
+                for name, repository in sorted(self.repositories.items())
+            },
+            "enabled_repositories": list(self.enabled_repositories),
+        }
 
-                logging.info(
-                    "Installing '{0}' from '{1}' into '{2}'".format(
-                        candidate.id, candidate.url, candidate.dir
+    def load_lockfile(self):
+        try:
+            with open(self.lockfile, "r") as f:
+                plan = json.load(f)
+        except FileNotFoundError:
+            raise Exception(
+                "lockfile '{0}' does not exist; install without locking first".format(
+                    self.lockfile
+                )
+            )
+
+        logging.info("Using lockfile '{0}'".format(self.lockfile))
+        self.pin(plan)
+
+        if plan.get("kodi_version") != str(self.kodi_version):
+            logging.warning(
+                "Lockfile '{0}' was written for Kodi {1}, not {2}".format(
+                    self.lockfile, plan.get("kodi_version"), self.kodi_version
+                )
+            )
+
+        return plan
+
+    # Write the plan for `graph` to the lockfile, and return it.  `plan`
+    # leaves out addons without a package, so a graph with any of those
+    # (say, one that failed, but is enabled already) is not written, lest
+    # `--locked` installs reproduce a different set of addons.
+    def write_lockfile(self, graph):
+        incomplete = sorted(
+            addon_id
+            for addon_id, node in graph.nodes.items()
+            if not node.core and (node.error is not None or node.source[1] is None)
+        )
+        if incomplete:
+            logging.warning(
+                "Not writing lockfile '{0}'; no package for addon(s) {1}".format(
+                    self.lockfile, ", ".join(incomplete)
+                )
+            )
+            return None
+
+        with contextlib.suppress(FileExistsError):
+            os.makedirs(os.path.dirname(os.path.abspath(self.lockfile)))
+
+        logging.info("Writing lockfile '{0}'".format(self.lockfile))
+        plan = self.plan(graph)
+        write_atomically(self.lockfile, (json.dumps(plan, indent=2) + "\n").encode())
+        return plan
+
+    # Download (without installing) the first candidate that works.
+    def download_addon(self, addon, candidates):
+        for repository, candidate in candidates:
+            try:
+                candidate.get()
+                return repository, candidate
+            except Exception as e:
+                logging.warning(
+                    "Failed to download '{0}' from '{1}': '{2}'".format(
+                        candidate.id, candidate.url, str(e)
                     )
                 )
-                candidate.fetch()
-                logging.info(
-                    "Installed '{0}' from '{1}' into '{2}'".format(
-                        candidate.id, candidate.url, candidate.dir
+
+        raise Exception("Failed to download '{0}'".format(addon.id))
+
+    # Resolve and download `self.addons` and their dependencies, without
+    # installing them; returns the dependency graph.
+    def resolve_and_download(self):
+        graph = DependencyGraph()
+        graph.requested.extend(addon.id for addon in self.addons)
+
+        if any(addon.url is None for addon in self.addons):
+            self.prefetch_catalogs()
+
+        pending = self.resolve(self.addons, graph)
+        while pending:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                futures = {
+                    executor.submit(
+                        self.download_addon, graph[addon_id].addon, graph[addon_id].candidates
+                    ): addon_id
+                    for addon_id in pending
+                    if graph[addon_id].fetchable
+                }
+
+            dependencies = []
+            for future, addon_id in futures.items():
+                node = graph[addon_id]
+                try:
+                    node.repository, node.candidate = future.result()
+                    # Packages are not extracted here, so read the
+                    # dependencies that `merge_fetched_dependencies` would
+                    # find on install from their `addon.xml`; addons fetched
+                    # from a URL have no catalog entry at all.  Otherwise,
+                    # the plan would not pin them.
+                    node.addon_xml = package_addon_xml(
+                        node.candidate.cache_target, addon_id
+                    )
+                except Exception as e:
+                    node.error = e
+                    node.reason = "fetch"
+                    continue
+
+                for imp in node.addon_xml.findall("requires/import"):
+                    node.require(imp.get("addon"), imp.get("version"))
+                dependencies.extend(node.dependencies)
+
+            pending = self.resolve(dependencies, graph)
+
+        self.mirrors.save()
+
+        errors = {
+            addon_id: node.error
+            for addon_id, node in graph.nodes.items()
+            if node.error is not None
+        }
+        if errors:
+            raise Exception(
+                "Failed to resolve and download the following addon(s): {0}".format(
+                    ", ".join(
+                        "{0} ({1})".format(addon_id, e) for addon_id, e in errors.items()
                     )
                 )
+            )
 
-                if repository is not None:
-                    logging.info(
-                        "Installing dependencies for '{0}' as specified in repository '{1}' file '{2}'".format(
-                            candidate.id, repository.name, repository.file
+        return graph
+
+    # Resolve and download `self.addons`, and write the plan to the lockfile
+    # without installing anything, so that hosts can `install --locked` from
+    # it without fetching or parsing repository catalogs themselves.  A
+    # lockfile for the same Kodi version, repositories and addons that is
+    # younger than the cache TTL is reused; concurrent invocations (say, one per Ansible host,
+    # all delegated to the controller) wait for each other, so that only the
+    # first one resolves.
+    def lock(self):
+        with contextlib.suppress(FileExistsError):
+            os.makedirs(os.path.dirname(os.path.abspath(self.lockfile)))
+
+        with open(self.lockfile + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            with contextlib.suppress(FileNotFoundError, ValueError):
+                if time.time() - os.path.getmtime(self.lockfile) <= self.cache_ttl:
+                    with open(self.lockfile, "r") as f:
+                        plan = json.load(f)
+                    if (
+                        plan.get("format") == self.PLAN_FORMAT
+                        and plan.get("kodi_version") == str(self.kodi_version)
+                        and all(
+                            plan.get(key) == value
+                            for key, value in self.plan_repositories().items()
+                        )
+                        and plan.get("addons") == [addon.id for addon in self.addons]
+                    ):
+                        logging.info("Reusing lockfile '{0}'".format(self.lockfile))
+                        return plan
+
+            graph = self.resolve_and_download()
+            return self.write_lockfile(graph)
+
+    # Resolve and download `self.addons` and their dependencies, and write
+    # them to the tar archive `path`, along with a manifest (the plan) and a
+    # Kodi-style `addons.xml` catalog of the bundled packages.
+    def export_bundle(self, path):
+        graph = self.resolve_and_download()
+        manifest = self.plan(graph)
+        catalog = ET.Element("addons")
+        for addon_id, entry in manifest["packages"].items():
+            entry["file"] = "packages/{0}-{1}.zip".format(addon_id, entry["version"])
+            catalog.append(graph[addon_id].addon_xml)
+
+        def anonymize(info):
+            info.uid = info.gid = 0
+            info.uname = info.gname = ""
+            return info
+
+        def add_bytes(bundle, name, data):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            info.mode = 0o644
+            bundle.addfile(info, io.BytesIO(data))
+
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(path)), delete=False
+        ) as out:
+            try:
+                with tarfile.open(fileobj=out, mode="w") as bundle:
+                    add_bytes(bundle, "manifest.json", json.dumps(manifest, indent=2).encode())
+                    add_bytes(bundle, "addons.xml", ET.tostring(catalog, encoding="utf-8"))
+                    for addon_id, entry in manifest["packages"].items():
+                        bundle.add(
+                            graph[addon_id].candidate.cache_target,
+                            arcname=entry["file"],
+                            filter=anonymize,
+                        )
+                out.flush()
+                os.fsync(out.fileno())
+                os.replace(out.name, path)
+            except Exception as e:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(out.name)
+                raise e
+
+        logging.info(
+            "Wrote {0} package(s) to bundle '{1}'".format(len(manifest["packages"]), path)
+        )
+        return manifest
+
+    # Unpack the packages in the bundle at `path` into the cache, where `get`
+    # finds them, verifying their checksums, and pin the bundle's plan.
+    def load_bundle(self, path):
+        with tarfile.open(path) as bundle:
+            manifest = json.load(bundle.extractfile("manifest.json"))
+            self.pin(manifest)
+
+            with contextlib.suppress(FileExistsError):
+                os.makedirs(self.cache_dir)
+
+            for addon_id, entry in manifest["packages"].items():
+                addon = self.pinned_addon(addon_id)
+                kind, digest = addon.checksum
+                target = addon.cache_target
+                if read_validators(target).get(kind) == digest and os.path.isfile(target):
+                    continue
+
+                logging.info(
+                    "Unpacking '{0}' from bundle into '{1}'".format(entry["file"], target)
+                )
+                h = hashlib.new(kind)
+                partial = "{0}.part".format(target)
+                with bundle.extractfile(entry["file"]) as f, open(partial, "wb") as out:
+                    for chunk in iter(lambda: f.read(1 << 16), b""):
+                        out.write(chunk)
+                        h.update(chunk)
+                if h.hexdigest() != digest:
+                    remove_partial(partial)
+                    raise Exception(
+                        "{0} checksum of '{1}' in bundle '{2}' is {3} rather than {4}".format(
+                            kind, entry["file"], path, h.hexdigest(), digest
                         )
                     )
-                    for dependency in repository.addon_imports(candidate.id):
-                        self.install_addon(dependency, seen=seen)
+                os.replace(partial, target)
+                write_validators(target, {kind: digest})
+
+        return manifest
+
+    def install_addon(self, addon):
+        failed = {}
+        self.install_addons([addon], DependencyGraph(), failed)
+        for e in failed.values():
+            raise e
 
+    # Download and extract the first candidate that works, without touching
+    # the addon database.  Runs on a worker thread, so it must only operate
+    # on the (already enumerated) `candidates`.
+    def fetch_addon(self, addon, candidates):
+        for repository, candidate in candidates:
+            if candidate.up_to_date():
                 logging.info(
-                    "Installing dependencies for '{0}' as specified in file '{1}'".format(
-                        candidate.id, candidate.file
+                    "'{0}' version {1} is already installed in '{2}'; skipping download".format(
+                        candidate.id, candidate.installed_version(), candidate.dir
                     )
                 )
-                for dependency in candidate.each_dependency():
-                    self.install_addon(dependency, seen=seen)
+                return repository, candidate
 
+            try:
                 logging.info(
-                    "Marking '{0}' as installed in '{1}'".format(
-                        candidate.id, self.database
+                    "Installing '{0}' from '{1}' into '{2}'".format(
+                        candidate.id, candidate.url, candidate.dir
                     )
                 )
-                self.handle.upsert_installed(candidate)
-
-                # Escape the outer `else` clause.
-                break
+                with self.tracer.span(
+                    "fetch addon",
+                    "addon",
+                    version=None if candidate.version is None else str(candidate.version),
+                    **candidate.trace_args(),
+                ):
+                    candidate.fetch()
+                logging.info(
+                    "Installed '{0}' from '{1}' into '{2}'".format(
+                        candidate.id, candidate.url, candidate.dir
+                    )
+                )
+                if repository is not None:
+                    self.mirrors.record(candidate.baseurl)
+                return repository, candidate
             except Exception as e:
+                if repository is not None:
+                    self.mirrors.record(candidate.baseurl, error=e)
                 logging.warning(
                     "Failed to install '{0}' from '{1}': '{2}'".format(
                         candidate.id, candidate.url, str(e)
                     )
                 )
                 logging.warning("Trying next candidate")
-        else:
-            if self.handle.addon_enabled(addon):
-                logging.warning(
-                    "Could not download and install '{0}', but it appears to be enabled already".format(
-                        addon.id
-                    )
-                )
-            else:
-                raise Exception("Failed to install '{0}'".format(addon.id))
 
-    def install(self):
-        self.handle.populate(self.database_version)
+        raise Exception("Failed to install '{0}'".format(addon.id))
 
-        seen = {}
-        failed = {}
+    # Add `addons` and everything they depend on to `graph`, using only
+    # repository catalogs and already-present `addon.xml` files.  Returns the
+    # IDs of the newly-added nodes.
+    def resolve(self, addons, graph=None):
+        if graph is None:
+            graph = DependencyGraph()
 
-        # Install repository addons first to make running the
-        # `UpdateAddonRepos` feature work properly.
-        repos, other = partition(
-            lambda addon: addon.id.startswith("repository."), self.addons
-        )
+        added = []
+        queue = [self.parse_addon(addon) for addon in addons]
+
+        while queue:
+            addon = self.parse_addon(queue.pop(0))
+
+            if addon.id in graph:
+                continue
+
+            logging.info("Resolving addon '{0}'".format(addon.id))
+            node = graph.add(DependencyNode(addon))
+            added.append(addon.id)
+
+            if self.addon_is_core(addon):
+                logging.info("Skipping core addon '{0}'".format(addon.id))
+                node.core = True
+                continue
+
+            if addon.id in self.pinned:
+                node.candidates = [(None, self.pinned_addon(addon.id))]
+                for dependency, version in self.pinned[addon.id]["dependencies"].items():
+                    node.require(dependency, version)
+                queue.extend(node.dependencies)
+                continue
 
-        def _install_addon(addon):
             try:
-                self.install_addon(addon, seen=seen)
+                node.candidates = list(self.each_addon_candidate(addon))
             except Exception as e:
-                failed[addon.id] = e
+                node.error = e
+                node.reason = "catalog"
+                continue
 
-        for addon in repos:
-            _install_addon(addon)
+            if node.candidates == []:
+                node.error = Exception(
+                    "Failed to install '{0}': not found in any enabled repository".format(
+                        addon.id
+                    )
+                )
+                node.reason = "not-found"
+                continue
+
+            repository, candidate = node.source
+            if repository is not None:
+                for imp in repository.addon_for_id(candidate.id).imports:
+                    node.require(imp.addon, imp.version)
+            elif candidate.installed():
+                # Addons fetched from a URL have no catalog entry; use the
+                # copy already present, if any.
+                for dependency in candidate.each_dependency():
+                    node.require(
+                        dependency.id,
+                        None if dependency.version is None else str(dependency.version),
+                    )
 
-        # Let this fail; Kodi might not be running or might not have the
-        # webserver enabled.
-        try:
-            kodi_send("--action=UpdateAddonRepos", "--action=UpdateLocalAddons")
-        except Exception as e:
-            logging.warning(
-                "Error updating addon repos with 'kodi-send': {0}".format(e)
+            queue.extend(node.dependencies)
+
+        return added
+
+    # After fetching, the repository that actually delivered the addon and the
+    # addon's own `addon.xml` may specify dependencies that the catalog-based
+    # resolution did not account for.
+    def merge_fetched_dependencies(self, node):
+        repository, candidate = node.repository, node.candidate
+        if repository is not None:
+            for imp in repository.addon_for_id(candidate.id).imports:
+                node.require(imp.addon, imp.version)
+        for dependency in candidate.each_dependency():
+            node.require(
+                dependency.id,
+                None if dependency.version is None else str(dependency.version),
             )
 
-        for addon in other:
-            _install_addon(addon)
+    def install_addons(self, addons, graph, failed):
+        addons = [self.parse_addon(addon) for addon in addons]
+        graph.requested.extend(addon.id for addon in addons)
 
-        try:
-            kodi_send("--action=UpdateLocalAddons")
-        except Exception as e:
+        logging.info(
+            "Resolving dependencies for {0}".format(
+                ", ".join("'{0}'".format(addon.id) for addon in addons)
+            )
+        )
+        with self.tracer.span(
+            "resolve", "manager", addons=[addon.id for addon in addons]
+        ) as span:
+            added = self.resolve(addons, graph)
+            span.set(resolved=len(added))
+
+        for cycle in graph.cycles():
+            logging.warning("Dependency cycle among {0}".format(", ".join(cycle)))
+        for conflict in graph.conflicts():
             logging.warning(
-                "Error updating local addons with 'kodi-send': {0}".format(e)
+                "'{required_by}' requires '{addon}' version {required}, but only version {available} is available".format(
+                    **conflict
+                )
             )
 
-        if failed != {}:
-            msg = "Failed to install the following addon(s): {0}".format(
-                ", ".join(
-                    [
-                        "{0} ({1})".format(addon_id, str(e))
-                        for addon_id, e in failed.items()
-                    ]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {}
+
+            # Start with the addons that others depend on.
+            def _submit(addon_ids):
+                addon_ids = set(addon_ids)
+                for level in graph.levels():
+                    for addon_id in level:
+                        node = graph[addon_id]
+                        if addon_id in addon_ids and node.fetchable:
+                            future = executor.submit(
+                                self.fetch_addon, node.addon, node.candidates
+                            )
+                            futures[future] = addon_id
+
+            _submit(added)
+
+            while futures:
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED
                 )
+                for future in done:
+                    node = graph[futures.pop(future)]
+                    try:
+                        node.repository, node.candidate = future.result()
+                    except Exception as e:
+                        node.error = e
+                        node.reason = "fetch"
+                        continue
+
+                    self.merge_fetched_dependencies(node)
+                    _submit(self.resolve(node.dependencies, graph))
+
+        # Settle outcomes level by level on the main thread, where the
+        # database handle lives.  An addon counts as installed only if it and
+        # all of its dependencies are, and dependencies are marked installed
+        # before their dependents.
+        for level in graph.levels():
+            cycle = set(level)
+            for addon_id in level:
+                self.settle_addon(graph, addon_id, cycle)
+
+        for addon in addons:
+            outcome = graph[addon.id].outcome
+            if outcome is not None:
+                failed[addon.id] = outcome
+
+    def settle_addon(self, graph, addon_id, same_level):
+        node = graph[addon_id]
+        if node.settled:
+            return node.outcome
+
+        outcome = None
+
+        if node.error is not None:
+            if self.handle.addon_enabled(node.addon):
+                logging.warning(
+                    "Could not download and install '{0}', but it appears to be enabled already".format(
+                        addon_id
+                    )
+                )
+            else:
+                outcome = node.error
+        else:
+            for dependency in graph.edges(addon_id):
+                # Members of the same level can only depend on each other
+                # through a cycle; those are treated as satisfied.
+                if dependency in same_level:
+                    continue
+                error = graph[dependency].outcome
+                if error is not None:
+                    outcome = Exception(
+                        "Failed to install '{0}': dependency '{1}' failed ({2})".format(
+                            addon_id, dependency, str(error)
+                        )
+                    )
+                    node.reason = "dependency"
+                    break
+
+        if outcome is None and node.candidate is not None and not node.marked:
+            logging.info(
+                "Marking '{0}' as installed in '{1}'".format(addon_id, self.database)
             )
+            self.handle.upsert_installed(node.candidate)
+            node.marked = True
 
-            missing_core = [
-                addon
-                for addon in self.KODI_CORE_ADDONS
-                if not self.handle.addon_installed(self.parse_addon(addon))
-            ]
+        node.outcome = outcome
+        node.settled = True
+        return outcome
+
+    def install(self):
+        graph = DependencyGraph()
+        with self.tracer.span(
+            "install", "manager", addons=[addon.id for addon in self.addons]
+        ) as span:
+            try:
+                self._install(graph)
+            finally:
+                self.mirrors.save()
+                span.set(
+                    failures=collections.Counter(
+                        node.reason
+                        for node in graph.nodes.values()
+                        if node.outcome is not None
+                    )
+                )
+
+    def _install(self, graph):
+        with contextlib.closing(self.handle):
+            self.handle.populate(self.database_version)
+
+            failed = {}
+
+            if self.locked:
+                unlocked = [
+                    addon.id
+                    for addon in self.addons
+                    if addon.id not in self.pinned and not self.addon_is_core(addon)
+                ]
+                if unlocked:
+                    raise Exception(
+                        "addon(s) {0} not in the lockfile; install without locking to add them".format(
+                            ", ".join(unlocked)
+                        )
+                    )
+
+            if any(
+                addon.url is None and addon.id not in self.pinned
+                for addon in self.addons
+            ):
+                self.prefetch_catalogs()
+
+            # Install repository addons first to make running the
+            # `UpdateAddonRepos` feature work properly.
+            repos, other = partition(
+                lambda addon: addon.id.startswith("repository."), self.addons
+            )
+
+            with self.handle.batch():
+                self.install_addons(repos, graph, failed)
 
-            if missing_core != []:
-                msg += " -- missing core addon(s) {0}; you may need to start and stop Kodi before attempting to install addons".format(
-                    ", ".join(missing_core)
+            # Let this fail; Kodi might not be running or might not have the
+            # webserver enabled.
+            try:
+                with self.tracer.span(
+                    "kodi_send",
+                    "manager",
+                    actions=["UpdateAddonRepos", "UpdateLocalAddons"],
+                ):
+                    kodi_send(
+                        "--action=UpdateAddonRepos", "--action=UpdateLocalAddons"
+                    )
+            except Exception as e:
+                logging.warning(
+                    "Error updating addon repos with 'kodi-send': {0}".format(e)
                 )
 
-            raise Exception(msg)
+            with self.handle.batch():
+                self.install_addons(other, graph, failed)
+
+            try:
+                with self.tracer.span(
+                    "kodi_send", "manager", actions=["UpdateLocalAddons"]
+                ):
+                    kodi_send("--action=UpdateLocalAddons")
+            except Exception as e:
+                logging.warning(
+                    "Error updating local addons with 'kodi-send': {0}".format(e)
+                )
+
+            if failed == {} and not self.locked:
+                self.write_lockfile(graph)
+
+            if failed != {}:
+                msg = "Failed to install the following addon(s): {0}".format(
+                    ", ".join(
+                        [
+                            "{0} ({1})".format(addon_id, str(e))
+                            for addon_id, e in failed.items()
+                        ]
+                    )
+                )
+
+                missing_core = [
+                    addon
+                    for addon in self.KODI_CORE_ADDONS
+                    if not self.handle.addon_installed(self.parse_addon(addon))
+                ]
+
+                if missing_core != []:
+                    msg += " -- missing core addon(s) {0}; you may need to start and stop Kodi before attempting to install addons".format(
+                        ", ".join(missing_core)
+                    )
+
+                raise Exception(msg)
 
-    def clean(self):
-        rmtree(self.cache_dir)
+    def clean(self, gc=False):
+        if gc:
+            PackageStore(self.store_dir, self.io_backend).gc()
+        else:
+            rmtree(self.cache_dir)
 
     def __repr__(self):
         return "<{0}.Manager data_dir={1} kodi_user={2} kodi_version={3}>".format(
@@ -1085,6 +4032,224 @@ class Manager(FilesystemMixin, KodiConfigMixin):
         )
 
 
+# Serves `GET /fetch?url=<URL>` from the cache directory of `manager`,
+# downloading (or revalidating) the file first if it is not fresh.  Requests
+# for the same URL are handled one at a time, so that concurrent requests
+# for a file wait for a single download and are then served from the cache.
+#
+# Only URLs under the directories of `manager`'s repositories, their
+# datadirs and the `allow` prefixes are served, so that the server is no
+# open proxy.
+class CacheServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, manager, allow=()):
+        super().__init__(address, CacheRequestHandler)
+        self.manager = manager
+        self.allow = list(allow)
+        # URL -> [lock, number of requests holding or waiting for it].
+        self._url_locks = {}
+        self._url_locks_lock = threading.Lock()
+        self._prefixes = None
+        self._prefixes_time = 0
+        self._prefixes_lock = threading.Lock()
+        # Checksum URL -> when the origin last answered 404 for it.
+        self._missing_checksums = {}
+
+    @staticmethod
+    def directory(url):
+        return url if url.endswith("/") else "{0}/".format(url)
+
+    # The allowed URL prefixes; datadirs come from the repository catalogs,
+    # so they are looked up again once the catalogs may have changed.
+    def allowed_prefixes(self):
+        with self._prefixes_lock:
+            if (
+                self._prefixes is None
+                or time.time() - self._prefixes_time > self.manager.cache_ttl
+            ):
+                self._prefixes = self.load_prefixes()
+                self._prefixes_time = time.time()
+            return self._prefixes
+
+    def load_prefixes(self):
+        prefixes = {self.directory(prefix) for prefix in self.allow}
+        for name, repository in self.manager.repositories.items():
+            prefixes.add(self.directory(repository.url.rsplit("/", 1)[0]))
+
+            # A repository of its own, so that a failure is not remembered
+            # past this lookup.
+            repository = Repository(
+                name,
+                url=repository.url,
+                **Repository.resolve_propagated_attributes(self.manager),
+            )
+            try:
+                prefixes.update(
+                    self.directory(datadir) for datadir in repository.each_datadir()
+                )
+            except Exception as e:
+                logging.warning(
+                    "Failed to look up datadirs of repository '{0}': {1}".format(
+                        name, e
+                    )
+                )
+        return sorted(prefixes)
+
+    def allowed(self, url):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+        if ".." in path.split("/"):
+            return False
+        return any(url.startswith(prefix) for prefix in self.allowed_prefixes())
+
+    # Serializes requests for `url`; the lock is dropped again once no
+    # request uses it, so that locks do not pile up for every URL served.
+    @contextlib.contextmanager
+    def url_lock(self, url):
+        with self._url_locks_lock:
+            entry = self._url_locks.setdefault(url, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._url_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._url_locks[url]
+
+    # Missing checksum files are common (and asked for with every package
+    # from a datadir without them), so 404s for them are cached, too.
+    def get(self, url):
+        checksum = url.rsplit(".", 1)[-1] in CHECKSUM_KINDS
+
+        with self.url_lock(url):
+            if checksum:
+                missing = self._missing_checksums.get(url)
+                if (
+                    missing is not None
+                    and time.time() - missing <= self.manager.cache_ttl
+                ):
+                    raise _HTTPStatusError(
+                        "server returned HTTP status 404 for '{0}'".format(url), 404
+                    )
+
+            package = CachedFile(
+                url=url, **CachedFile.resolve_propagated_attributes(self.manager)
+            )
+            try:
+                return package.get()
+            except _HTTPStatusError as e:
+                if checksum and e.status == 404:
+                    self.remember_missing(url)
+                raise
+
+    def remember_missing(self, url):
+        now = time.time()
+        with self._url_locks_lock:
+            for expired in [
+                missing_url
+                for missing_url, missing in self._missing_checksums.items()
+                if now - missing > self.manager.cache_ttl
+            ]:
+                del self._missing_checksums[expired]
+            self._missing_checksums[url] = now
+
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def log_message(self, format, *args):
+        logging.info("{0} - {1}".format(self.address_string(), format % args))
+
+    def serve(self, body):
+        request = urllib.parse.urlsplit(self.path)
+        urls = urllib.parse.parse_qs(request.query).get("url", [])
+        if (
+            request.path != "/fetch"
+            or len(urls) != 1
+            or urllib.parse.urlsplit(urls[0]).scheme not in ("http", "https")
+        ):
+            self.send_error(400, "Expected /fetch?url=<http(s) URL>")
+            return
+
+        if not self.server.allowed(urls[0]):
+            self.send_error(403, "Not a URL of a configured repository")
+            return
+
+        try:
+            target = self.server.get(urls[0])
+        except _HTTPStatusError as e:
+            self.send_error(404 if e.status == 404 else 502, str(e))
+            return
+        except Exception as e:
+            logging.warning("Failed to fetch '{0}': {1}".format(urls[0], e))
+            self.send_error(502, str(e))
+            return
+
+        # Hand out the origin's validators, so that clients can revalidate
+        # and resume against the cache as they would against the origin.
+        validators = read_validators(target)
+        etag = validators.get("etag")
+        last_modified = validators.get("last-modified")
+
+        with open(target, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+
+            if (etag is not None and self.headers.get("If-None-Match") == etag) or (
+                etag is None
+                and last_modified is not None
+                and self.headers.get("If-Modified-Since") == last_modified
+            ):
+                self.send_response(304)
+                self.send_validators(etag, last_modified)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            start = 0
+            resume = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+            if resume is not None and self.headers.get("If-Range") in (
+                None,
+                etag,
+                last_modified,
+            ):
+                start = int(resume.group(1))
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */{0}".format(size))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+            self.send_response(206 if start > 0 else 200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(size - start))
+            self.send_header("Accept-Ranges", "bytes")
+            if start > 0:
+                self.send_header(
+                    "Content-Range", "bytes {0}-{1}/{2}".format(start, size - 1, size)
+                )
+            self.send_validators(etag, last_modified)
+            self.end_headers()
+
+            if body:
+                f.seek(start)
+                shutil.copyfileobj(f, self.wfile, 1 << 16)
+
+    def send_validators(self, etag, last_modified):
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if last_modified is not None:
+            self.send_header("Last-Modified", last_modified)
+
+
 class CLI:
     def __init__(self):
         self.parser = argparse.ArgumentParser(
@@ -1140,6 +4305,45 @@ class CLI:
             action="append",
             default=shlex.split(os.environ.get("ENABLED_REPOSITORIES", "")),
         )
+        self.parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            help="The number of addon packages to download and extract concurrently",
+            default=os.environ.get("JOBS", "1"),
+        )
+        self.parser.add_argument(
+            "-t",
+            "--cache-ttl",
+            type=int,
+            help="The number of seconds to use cached repository and addon data before revalidating it with the server",
+            default=os.environ.get("CACHE_TTL", str(FilesystemMixin.CACHE_TTL_DEFAULT)),
+        )
+        self.parser.add_argument(
+            "--io-backend",
+            choices=sorted(IO_BACKENDS),
+            help="How to download, verify and extract files: in-process ('native') or with `curl`, `unzip` and `gunzip` ('subprocess')",
+            default=os.environ.get("IO_BACKEND", IOMixin.IO_BACKEND_DEFAULT),
+        )
+        self.parser.add_argument(
+            "--install-mode",
+            choices=FilesystemMixin.INSTALL_MODES,
+            help="How to install addon files: unzip each package into the addons directory ('extract'), or unzip it into a package store once and hard-link, reflink or copy from there",
+            default=os.environ.get("INSTALL_MODE", FilesystemMixin.INSTALL_MODE_DEFAULT),
+        )
+        self.parser.add_argument(
+            "--upstream-cache",
+            metavar="URL",
+            help="Download through this `serve-cache` instance (e.g. http://cache.lan:8780), falling back to the origin if it fails",
+            default=os.environ.get("UPSTREAM_CACHE") or None,
+        )
+        self.parser.add_argument(
+            "--trace",
+            dest="tracer",
+            metavar="FILE",
+            help="Write timings of each phase (catalog download and parsing, dependency resolution, addon downloads and extraction, database writes, `kodi-send`) to this file, in Chrome trace event format",
+            default=os.environ.get("TRACE") or None,
+        )
 
         subparsers = self.parser.add_subparsers(
             title="subcommands", description="modes of operation"
@@ -1148,32 +4352,201 @@ class CLI:
         install = subparsers.add_parser("install", help="Install a Kodi addon")
         install.add_argument(
             "addons",
-            help="Addons to install",
-            nargs="+",
+            help="Addons to install (by default, with --from-bundle, those the bundle was made for)",
+            nargs="*",
+        )
+        install.add_argument(
+            "--lockfile",
+            help="Where to record exactly what was installed, for --locked (default: addons.lock.json in the cache directory)",
+            default=os.environ.get("LOCKFILE") or None,
+        )
+        install.add_argument(
+            "--locked",
+            help="Install the versions recorded in the lockfile, without downloading or parsing repository catalogs",
+            action="store_true",
+            default=os.environ.get("LOCKED", "").lower() in ("1", "true", "yes"),
+        )
+        install.add_argument(
+            "--metrics-dir",
+            help="Write Prometheus metrics about downloads, the cache, addon installation and failures to kodi_addons.prom in this directory (say, that of node_exporter's textfile collector) at the end of the run",
+            default=os.environ.get("METRICS_DIR") or None,
+        )
+        install.add_argument(
+            "--from-bundle",
+            help="Install from a bundle made with `export-bundle`, without downloading anything",
+            default=os.environ.get("ADDONS_BUNDLE") or None,
         )
         install.set_defaults(func=self.install)
 
         clean = subparsers.add_parser(
             "clean", help="Clean up cached Kodi addon and repository data"
         )
+        clean.add_argument(
+            "--gc",
+            help="Only remove package store entries that no installed addon uses",
+            action="store_true",
+        )
         clean.set_defaults(func=self.clean)
 
+        resolve = subparsers.add_parser(
+            "resolve",
+            help="Print the dependency graph of Kodi addons as JSON, using only cached repository data",
+        )
+        resolve.add_argument(
+            "addons",
+            help="Addons to resolve",
+            nargs="+",
+        )
+        resolve.add_argument(
+            "-o",
+            "--output",
+            help="Write the dependency graph to this file rather than to standard output",
+        )
+        resolve.set_defaults(func=self.resolve)
+
+        lock = subparsers.add_parser(
+            "lock",
+            help="Resolve and download Kodi addons and their dependencies, and write the lockfile for `install --locked`, without installing anything",
+        )
+        lock.add_argument(
+            "addons",
+            help="Addons to lock",
+            nargs="+",
+        )
+        lock.add_argument(
+            "--lockfile",
+            help="The lockfile to write; one for the same Kodi version and addons that is younger than the cache TTL is reused (default: addons.lock.json in the cache directory)",
+            default=os.environ.get("LOCKFILE") or None,
+        )
+        lock.set_defaults(func=self.lock)
+
+        export_bundle = subparsers.add_parser(
+            "export-bundle",
+            help="Resolve and download Kodi addons and their dependencies into a bundle for `install --from-bundle`",
+        )
+        export_bundle.add_argument(
+            "addons",
+            help="Addons to bundle",
+            nargs="+",
+        )
+        export_bundle.add_argument(
+            "-o",
+            "--output",
+            help="The bundle (tar archive) to write",
+            required=True,
+        )
+        export_bundle.set_defaults(func=self.export_bundle)
+
+        serve_cache = subparsers.add_parser(
+            "serve-cache",
+            help="Serve repository and addon downloads to other hosts from the cache directory, downloading them on first request",
+        )
+        serve_cache.add_argument(
+            "-l",
+            "--listen",
+            metavar="[ADDRESS:]PORT",
+            help="Where to listen (default: %(default)s); listen on e.g. 0.0.0.0:8780 to serve other hosts",
+            default="127.0.0.1:8780",
+        )
+        serve_cache.add_argument(
+            "-a",
+            "--allow",
+            metavar="URL_PREFIX",
+            action="append",
+            help="Also serve URLs under this prefix (repeatable); by default, only URLs under the directories of the repositories given with --repository and their datadirs are served",
+            default=[],
+        )
+        serve_cache.set_defaults(func=self.serve_cache)
+
         self.parser.set_defaults(func=self.install)
 
-    def manager_from(self, args):
-        return Manager(**vars(args))
+    def manager_from(self, args, **kwargs):
+        return Manager(**vars(args), **kwargs)
 
     def run(self, args):
         parsed = self.parser.parse_args(args)
-        parsed.func(parsed)
+
+        tracers = []
+        if parsed.tracer is not None:
+            tracers.append(Tracer(parsed.tracer))
+        if getattr(parsed, "metrics_dir", None) is not None:
+            tracers.append(Metrics(parsed.metrics_dir))
+        parsed.tracer = (
+            None
+            if tracers == []
+            else tracers[0] if len(tracers) == 1 else TracerGroup(tracers)
+        )
+
+        try:
+            parsed.func(parsed)
+        finally:
+            if parsed.tracer is not None:
+                parsed.tracer.write()
 
     def install(self, args):
-        manager = self.manager_from(args)
+        if getattr(args, "from_bundle", None) is None:
+            manager = self.manager_from(args)
+        else:
+            manager = self.manager_from(args, offline=True)
+            manifest = manager.load_bundle(args.from_bundle)
+            if not args.addons:
+                manager.addons = manifest["addons"]
+
+        if manager.locked:
+            plan = manager.load_lockfile()
+            if not args.addons:
+                manager.addons = plan["addons"]
+
         manager.install()
 
     def clean(self, args):
         manager = self.manager_from(args)
-        manager.clean()
+        manager.clean(gc=args.gc)
+
+    def resolve(self, args):
+        manager = self.manager_from(args, offline=True)
+
+        graph = DependencyGraph()
+        graph.requested.extend(addon.id for addon in manager.addons)
+        manager.resolve(manager.addons, graph)
+
+        output = json.dumps(graph.to_json(), indent=2)
+        if args.output is None:
+            print(output)
+        else:
+            write_atomically(args.output, (output + "\n").encode())
+
+    def lock(self, args):
+        manager = self.manager_from(args)
+        manager.lock()
+
+    def serve_cache(self, args):
+        # Serve from the origin, never from (possibly) ourselves.
+        args.upstream_cache = None
+        manager = self.manager_from(args)
+
+        with contextlib.suppress(FileExistsError):
+            os.makedirs(manager.cache_dir)
+
+        if not manager.repositories and not args.allow:
+            logging.warning(
+                "No repositories or --allow prefixes given; every request will be refused"
+            )
+
+        address, _, port = args.listen.rpartition(":")
+        server = CacheServer(
+            (address or "127.0.0.1", int(port)), manager, allow=args.allow
+        )
+        logging.info(
+            "Serving '{0}' on {1}:{2}".format(manager.cache_dir, *server.server_address)
+        )
+        with contextlib.suppress(KeyboardInterrupt):
+            server.serve_forever()
+        server.server_close()
+
+    def export_bundle(self, args):
+        manager = self.manager_from(args)
+        manager.export_bundle(args.output)
 
 
 if __name__ == "__main__":
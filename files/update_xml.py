@@ -2,68 +2,262 @@
 
 from xml.etree import ElementTree as et
 from xml.etree.ElementTree import SubElement as SubE
-import re
+import contextlib
+import functools
+import json
 import os
 import pwd
+import re
+import shutil
 import sys
+import tempfile
 
-if len(sys.argv) != 5:
-    print('Exactly 4 arguments required (file, path, value, type)')
-    sys.exit(1)
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
-filename, path, value, datatype = sys.argv[1:]
+USAGE = '''Usage:
+  update_xml.py [--json] [--dry-run] FILE PATH VALUE TYPE
+  update_xml.py [--json] [--dry-run] --batch EDITS
 
-print('Path: **{0}**, value: **{1}**'.format(path, value))
+EDITS is a file (or "-" for standard input) holding a JSON (or, if PyYAML is
+available, YAML) list of objects with "file", "key", "value" and "type"
+attributes.  Edits are grouped by file, and each file is written only once.
 
-kodi_user = os.environ.get('KODI_USER', pwd.getpwuid(os.geteuid()).pw_name)
-data_dir = os.path.expanduser(os.environ.get('KODI_DATA_DIR', '~{0}/.kodi'.format(kodi_user)))
-filename = os.path.join(data_dir, filename)
+Files are only written (via a temporary file renamed into place) if at least
+one of their settings changed.  With --json, a JSON object reporting whether
+each setting changed is printed to standard output; progress messages always
+go to standard error.  With --dry-run, changes are reported but no file is
+written.'''
 
-tree = et.parse(filename)
-root = tree.getroot()
 
-tag, *rest = path.split('/')
+class SettingError(Exception):
+    pass
 
-if root.tag != tag:
-    print('Document "{0}" uses root tag "{1}", not the supplied tag "{2}"'.format(filename, root.tag, tag))
-    sys.exit(1)
 
-path = '/'.join(rest)
+def data_dir():
+    kodi_user = os.environ.get('KODI_USER', pwd.getpwuid(os.geteuid()).pw_name)
+    return os.path.expanduser(os.environ.get('KODI_DATA_DIR', '~{0}/.kodi'.format(kodi_user)))
 
-# do we need to create this node/tree?
-match = root.find(path)
 
-# ok, yes we do
-if match is None:
-    path_components = re.findall(r'[a-z0-9]+(?:\[@[^]]+\])?', path)
-    mount_element = root
-    for node in path_components:
-        match = mount_element.find(node)
-        if match is None:
-            break
-        else:
-            print('found {0}'.format(node))
-            mount_element = match
-            path_components.pop(0)
-    parent = mount_element
-    for node in path_components:
-        node_name = re.match(r'[^[]+', node).group(0)
-        match = re.search(r'@([^=]+)="?([^"]]+)"?]', node)
-        match = re.search(r'\[@([^=]+)="?([^]"]+)"?', node)
-        if match:
-            attribute_name, attribute_value = match.group(1), match.group(2)
-            print(attribute_name, attribute_value)
-            parent = SubE(parent, node_name, {match.group(1): match.group(2)})
+def log(*args):
+    print(*args, file=sys.stderr)
+
+
+# the parts of a setting node that applying a setting may modify
+def node_state(node):
+    if node is None:
+        return None
+    return (node.text, node.attrib.get('type'), 'default' in node.attrib)
+
+
+# one step of a settings path: a tag, optionally followed by `[@name="value"]`
+# predicates (quoted with double, single or no quotes)
+STEP = re.compile(r'''([^/\[\]@="']+)((?:\[@[^=\]]+=(?:"[^"]*"|'[^']*'|[^\]"']*)\])*)(?:/|$)''')
+PREDICATE = re.compile(r'''\[@([^=\]]+)=(?:"([^"]*)"|'([^']*)'|([^\]"']*))\]''')
+
+
+# tokenize a settings path once into a tuple of (tag, ((name, value), ...))
+# steps; batches typically reuse the same handful of parent paths
+@functools.lru_cache(maxsize=None)
+def compile_path(path):
+    steps = []
+    position = 0
+    while position < len(path):
+        step = STEP.match(path, position)
+        if step is None:
+            raise SettingError('Unsupported path "{0}" (at offset {1})'.format(path, position))
+        predicates = tuple((m.group(1), next(g for g in m.groups()[1:] if g is not None))
+                           for m in PREDICATE.finditer(step.group(2)))
+        steps.append((step.group(1), predicates))
+        position = step.end()
+
+    if not steps:
+        raise SettingError('Empty path')
+
+    return tuple(steps)
+
+
+class Document:
+    def __init__(self, filename):
+        self.filename = filename
+        self.tree = et.parse(filename)
+        self.root = self.tree.getroot()
+        # resolved elements by path prefix, and children by (parent, tag,
+        # attribute name) and attribute value, for `setting[@id=...]` lookups
+        self.elements = {((self.root.tag, ()),): self.root}
+        self.indexes = {}
+
+    def index(self, parent, tag, name):
+        key = (parent, tag, name)
+        if key not in self.indexes:
+            index = {}
+            for child in parent.iterfind(tag):
+                value = child.get(name)
+                if value is not None:
+                    index.setdefault(value, child)
+            self.indexes[key] = index
+        return self.indexes[key]
+
+    def child(self, parent, tag, predicates):
+        if len(predicates) == 1:
+            name, value = predicates[0]
+            return self.index(parent, tag, name).get(value)
+
+        for child in parent.iterfind(tag):
+            if all(child.get(name) == value for name, value in predicates):
+                return child
+
+        return None
+
+    def create(self, parent, tag, predicates):
+        log('creating {0} {1}'.format(tag, dict(predicates)))
+        element = SubE(parent, tag, dict(predicates))
+        for name, value in predicates:
+            key = (parent, tag, name)
+            if key in self.indexes:
+                self.indexes[key].setdefault(value, element)
+        return element
+
+    # find the element for `steps`, or None if it does not exist yet
+    def lookup(self, steps):
+        if steps not in self.elements:
+            parent = self.lookup(steps[:-1])
+            element = None if parent is None else self.child(parent, *steps[-1])
+            if element is None:
+                return None
+            self.elements[steps] = element
+        return self.elements[steps]
+
+    # find the element for `steps`, creating any missing ones along the way
+    def resolve(self, steps):
+        if steps not in self.elements:
+            parent = self.resolve(steps[:-1])
+            element = self.child(parent, *steps[-1])
+            self.elements[steps] = self.create(parent, *steps[-1]) if element is None else element
+        return self.elements[steps]
+
+    # set the value and type of the node at `path`, creating it if necessary,
+    # and drop its `default` attribute; returns whether anything changed
+    def apply(self, path, value, datatype):
+        log('Path: **{0}**, value: **{1}**'.format(path, value))
+
+        steps = compile_path(path)
+        if steps[0] != (self.root.tag, ()):
+            raise SettingError('Document "{0}" uses root tag "{1}", not the supplied tag "{2}"'.format(self.filename, self.root.tag, path.split('/')[0]))
+
+        before = node_state(self.lookup(steps))
+        match = self.resolve(steps)
+
+        # setting value
+        match.text = str(value)
+        match.attrib.update({'type': datatype})
+        if 'default' in match.attrib:
+            match.attrib.pop('default')
+
+        return node_state(match) != before
+
+
+# write to a temporary file next to the target and rename it into place, so
+# that a crash never leaves a truncated settings file behind
+def write_tree(tree, filename):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.{0}.'.format(os.path.basename(filename)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            tree.write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        with contextlib.suppress(FileNotFoundError):
+            shutil.copymode(filename, tmp)
+            st = os.stat(filename)
+            with contextlib.suppress(PermissionError):
+                os.chown(tmp, st.st_uid, st.st_gid)
+        os.replace(tmp, filename)
+    except Exception:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+
+
+def load_edits(source):
+    if source == '-':
+        text = sys.stdin.read()
+    else:
+        with open(source) as f:
+            text = f.read()
+
+    try:
+        edits = json.loads(text)
+    except ValueError:
+        if yaml is None:
+            raise
+        edits = yaml.safe_load(text)
+
+    if not isinstance(edits, list):
+        raise SettingError('Expected a list of edits, got {0}'.format(type(edits).__name__))
+
+    return edits
+
+
+def update_files(edits, dry_run=False):
+    # group edits by file, keeping their order
+    by_file = {}
+    for edit in edits:
+        by_file.setdefault(edit['file'], []).append(edit)
+
+    results = []
+    for relative, file_edits in by_file.items():
+        filename = os.path.join(data_dir(), relative)
+        document = Document(filename)
+        dirty = False
+        for edit in file_edits:
+            changed = document.apply(edit['key'], edit['value'], edit['type'])
+            results.append({'file': relative, 'key': edit['key'], 'changed': changed})
+            dirty = dirty or changed
+
+        # leave files whose settings are all current untouched, so that their
+        # mtime is kept and flash storage is not needlessly written to
+        if dirty and dry_run:
+            log('"{0}" would be written (dry run)'.format(filename))
+        elif dirty:
+            write_tree(document.tree, filename)
         else:
-            parent = SubE(parent, node_name)
-    match = root.find(path)
-
-# setting value
-match.text = str(value)
-match.attrib.update({'type': datatype})
-if 'default' in match.attrib:
-    match.attrib.pop('default')
-
-# et.dump(root)
-# write the changes back
-tree.write(filename)
+            log('"{0}" is up to date, not writing it'.format(filename))
+
+    return results
+
+
+def main(args):
+    flags = set()
+    while args[:1] in (['--json'], ['--dry-run']):
+        flags.add(args.pop(0))
+    report = '--json' in flags
+
+    if len(args) == 2 and args[0] == '--batch':
+        edits = load_edits(args[1])
+    elif len(args) == 4:
+        filename, path, value, datatype = args
+        edits = [{'file': filename, 'key': path, 'value': value, 'type': datatype}]
+    else:
+        print('Exactly 4 arguments required (file, path, value, type)')
+        print(USAGE)
+        return 1
+
+    try:
+        results = update_files(edits, dry_run='--dry-run' in flags)
+    except SettingError as e:
+        print(e)
+        return 1
+
+    for result in results:
+        log('{0}: {1} in "{2}"'.format('changed' if result['changed'] else 'unchanged', result['key'], result['file']))
+
+    if report:
+        print(json.dumps({'changed': any(result['changed'] for result in results), 'results': results}))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
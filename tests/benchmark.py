@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+
+# Benchmark `get_kodi_addon.py` and `update_xml.py` against synthetic
+# repositories served from a local HTTP server.
+#
+# Every scenario runs in a fresh interpreter, so that its peak RSS is not
+# inflated by earlier ones, and the results are written as JSON for comparing
+# releases.  See "Benchmarks" in CONTRIBUTING.md.
+
+import argparse
+import concurrent.futures
+import contextlib
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "files"))
+
+import get_kodi_addon  # noqa: E402
+import update_xml  # noqa: E402
+
+# Bump this whenever the meaning of a result field changes.
+RESULTS_FORMAT = 1
+
+KODI_VERSION = "21.0"
+ROOT_ADDON = "plugin.bench"
+REPOSITORY = "bench"
+
+SCENARIOS = [
+    "install-cold",
+    "install-warm",
+    "lookup-cold",
+    "lookup-warm",
+    "update-xml",
+    "update-xml-noop",
+]
+
+
+class CountingWriter:
+    def __init__(self, stream, counter):
+        self.stream = stream
+        self.counter = counter
+
+    def write(self, data):
+        self.counter.add(len(data))
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class TrafficCounter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.bytes = 0
+            self.requests = 0
+
+    def add(self, size):
+        with self.lock:
+            self.bytes += size
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"bytes_transferred": self.bytes, "requests": self.requests}
+
+
+# Serves the fixture directory, counting requests and every byte written to
+# clients (headers included).  Like a real mirror, it answers conditional
+# requests (`If-Modified-Since`) with 304s.
+class BenchmarkHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this, delayed ACKs
+    # add 40ms to each keep-alive request.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.wfile = CountingWriter(self.wfile, self.server.counter)
+
+    def send_head(self):
+        self.server.counter.request()
+        return super().send_head()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BenchmarkServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root):
+        self.counter = TrafficCounter()
+        handler = lambda *args, **kwargs: BenchmarkHandler(  # noqa: E731
+            *args, directory=root, **kwargs
+        )
+        super().__init__(("127.0.0.1", 0), handler)
+
+    @property
+    def url(self):
+        return "http://{0}:{1}".format(*self.server_address)
+
+
+def addon_xml(addon_id, version, imports):
+    requires = "".join(
+        '<import addon="{0}" version="1.0.0"/>'.format(imp) for imp in imports
+    )
+    return (
+        '<addon id="{0}" version="{1}" name="{0}" provider-name="bench">'
+        "<requires>{2}</requires>"
+        '<extension point="xbmc.python.pluginsource" library="default.py"/>'
+        "</addon>"
+    ).format(addon_id, version, requires)
+
+
+# The dependency tree below the root addon: each addon on level `n` imports
+# `fan_out` addons on level `n + 1`, down to `depth` levels.
+def dependency_tree(depth, fan_out):
+    tree = {ROOT_ADDON: []}
+    level = [ROOT_ADDON]
+    for n in range(1, depth + 1):
+        next_level = []
+        for parent_index, parent in enumerate(level):
+            for child_index in range(fan_out):
+                child = "script.bench.{0}.{1}".format(
+                    n, parent_index * fan_out + child_index
+                )
+                tree[parent].append(child)
+                tree[child] = []
+                next_level.append(child)
+        level = next_level
+    return tree
+
+
+def write_checksum(path, kind):
+    with open("{0}.{1}".format(path, kind), "w") as f:
+        f.write(
+            "{0}  {1}\n".format(
+                get_kodi_addon.file_digest(path, h=hashlib.new(kind)),
+                os.path.basename(path),
+            )
+        )
+
+
+def write_packages(root, tree, package_size, checksums):
+    for addon_id, imports in tree.items():
+        directory = os.path.join(root, addon_id)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "{0}-1.0.0.zip".format(addon_id))
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr(
+                "{0}/addon.xml".format(addon_id),
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                + addon_xml(addon_id, "1.0.0", ["xbmc.python", *imports]),
+            )
+            z.writestr("{0}/default.py".format(addon_id), "pass\n")
+            # Incompressible, like the artwork most packages consist of.
+            z.writestr("{0}/resources/fanart.bin".format(addon_id), os.urandom(package_size))
+        if checksums:
+            write_checksum(path, "sha256")
+
+
+# A catalog of `size` addons: the dependency tree, padded with unrelated
+# addons (each in two versions, like on the official mirrors).  Catalogs live
+# next to the packages, so that the default datadir is the published one.
+def write_catalog(root, size, tree, baseurl, checksums):
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<addons>\n']
+    for addon_id, imports in tree.items():
+        parts.append(addon_xml(addon_id, "1.0.0", ["xbmc.python", *imports]))
+        parts.append("\n")
+    for n in range(max(0, size - len(tree))):
+        for version in ("1.0.0", "1.1.0"):
+            parts.append(
+                addon_xml("plugin.filler.{0}".format(n), version, ["xbmc.python"])
+            )
+            parts.append("\n")
+    parts.append(
+        '<addon id="repository.bench" version="1.0.0" name="bench">'
+        '<extension point="xbmc.addon.repository"><dir>'
+        '<info compressed="true">{0}/addons-{1}.xml.gz</info>'
+        '<datadir zip="true">{0}</datadir>'
+        "</dir></extension></addon>\n</addons>\n".format(baseurl, size)
+    )
+
+    path = os.path.join(root, "addons-{0}.xml.gz".format(size))
+    with gzip.open(path, "wb") as f:
+        f.write("".join(parts).encode())
+    if checksums:
+        write_checksum(path, "md5")
+
+    return "{0}/addons-{1}.xml.gz".format(baseurl, size)
+
+
+def write_settings(root, count):
+    userdata = os.path.join(root, "userdata")
+    os.makedirs(userdata, exist_ok=True)
+
+    parts = ['<settings version="2">\n']
+    for n in range(count):
+        parts.append(
+            '    <setting id="bench.setting{0}" default="true">{0}</setting>\n'.format(n)
+        )
+    parts.append("</settings>\n")
+    with open(os.path.join(userdata, "guisettings.xml"), "w") as f:
+        f.write("".join(parts))
+
+    # Change every other setting, and add as many new ones.
+    edits = [
+        {
+            "file": "userdata/guisettings.xml",
+            "key": 'settings/setting[@id="bench.setting{0}"]'.format(n),
+            "value": n + (n % 2),
+            "type": "integer",
+        }
+        for n in range(count + count // 2)
+    ]
+    path = os.path.join(root, "edits.json")
+    with open(path, "w") as f:
+        json.dump(edits, f)
+    return path
+
+
+# Counts every child process `get_kodi_addon` starts (`curl`, `unzip`,
+# `kodi-send`, ...), including those that fail to start.
+def count_subprocesses():
+    counter = {"subprocesses": 0}
+
+    class CountingPopen(subprocess.Popen):
+        def __init__(self, *args, **kwargs):
+            counter["subprocesses"] += 1
+            super().__init__(*args, **kwargs)
+
+    subprocess.Popen = CountingPopen
+    return counter
+
+
+# `ru_maxrss` survives `exec`, so a fresh interpreter would report (at least)
+# the peak of the benchmark process itself; `VmHWM` does not.
+def peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with contextlib.suppress(OSError):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    peak = int(line.split()[1])
+
+    return {
+        "peak_rss_kib": peak,
+        "children_peak_rss_kib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def make_manager(spec):
+    return get_kodi_addon.Manager(
+        kodi_version=KODI_VERSION,
+        data_dir=spec["data_dir"],
+        cache_dir=spec["cache_dir"],
+        cache_ttl=spec["cache_ttl"],
+        repositories=["{0}={1}".format(REPOSITORY, spec["url"])],
+        enabled_repositories=[REPOSITORY],
+        addons=[ROOT_ADDON],
+        io_backend=spec["io_backend"],
+        install_mode=spec["install_mode"],
+        jobs=spec["jobs"],
+    )
+
+
+# Runs in a fresh interpreter; returns the measurements of one scenario.
+def run_scenario(spec):
+    logging.basicConfig(level=spec["log_level"], stream=sys.stderr)
+    counter = count_subprocesses()
+    result = {}
+
+    start = time.perf_counter()
+    if spec["scenario"].startswith("install"):
+        make_manager(spec).install()
+    elif spec["scenario"].startswith("lookup"):
+        repository = make_manager(spec).repositories[REPOSITORY]
+        rng = random.Random(spec["size"])
+        ids = [ROOT_ADDON] + [
+            "plugin.filler.{0}".format(rng.randrange(max(1, spec["size"])))
+            for _ in range(spec["lookups"] - 1)
+        ]
+        found = sum(repository.addon_for_id(addon_id) is not None for addon_id in ids)
+        result["lookups"] = len(ids)
+        result["found"] = found
+    elif spec["scenario"].startswith("update-xml"):
+        os.environ["KODI_DATA_DIR"] = spec["data_dir"]
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+            io.StringIO()
+        ):
+            status = update_xml.main(["--json", "--batch", spec["edits"]])
+        if status != 0:
+            raise Exception("update_xml.py exited with status {0}".format(status))
+    result["wall_time"] = time.perf_counter() - start
+
+    result.update(peak_rss())
+    result.update(counter)
+    return result
+
+
+def run_isolated(spec):
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as pool:
+        return pool.submit(run_scenario, spec).result()
+
+
+def parse_sizes(s):
+    return [int(size) for size in s.split(",") if size]
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Benchmark get_kodi_addon.py and update_xml.py against a local, synthetic repository"
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        type=parse_sizes,
+        help="Comma-separated catalog sizes, in addons (default: %(default)s)",
+        default="100,1000,10000",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        help="Levels of dependencies below the installed addon (default: %(default)s)",
+        default=3,
+    )
+    parser.add_argument(
+        "--fan-out",
+        type=int,
+        help="Dependencies per addon (default: %(default)s)",
+        default=3,
+    )
+    parser.add_argument(
+        "--package-size",
+        type=int,
+        help="Bytes of payload in each addon package (default: %(default)s)",
+        default=64 * 1024,
+    )
+    parser.add_argument(
+        "--no-checksums",
+        dest="checksums",
+        help="Do not publish checksum files next to packages and catalogs",
+        action="store_false",
+    )
+    parser.add_argument(
+        "--lookups",
+        type=int,
+        help="`Repository.addon_for_id` calls per lookup scenario (default: %(default)s)",
+        default=1000,
+    )
+    parser.add_argument(
+        "--settings",
+        type=int,
+        help="Settings in the `update_xml.py` fixture (default: %(default)s)",
+        default=5000,
+    )
+    parser.add_argument(
+        "--scenarios",
+        type=lambda s: s.split(","),
+        help="Comma-separated scenarios to run, out of {0} (default: all)".format(
+            ", ".join(SCENARIOS)
+        ),
+        default=SCENARIOS,
+    )
+    parser.add_argument(
+        "--io-backend",
+        dest="io_backends",
+        choices=sorted(get_kodi_addon.IO_BACKENDS),
+        help="I/O backend to benchmark; may be repeated (default: all)",
+        action="append",
+    )
+    parser.add_argument(
+        "--install-mode",
+        choices=get_kodi_addon.FilesystemMixin.INSTALL_MODES,
+        default=get_kodi_addon.FilesystemMixin.INSTALL_MODE_DEFAULT,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-n",
+        "--repeat",
+        type=int,
+        help="Runs of each scenario (default: %(default)s)",
+        default=1,
+    )
+    parser.add_argument(
+        "--log-level",
+        help="Logging level of the benchmarked code (default: %(default)s)",
+        default="WARNING",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Write the results to this file rather than to standard output",
+    )
+    parser.add_argument(
+        "--keep",
+        help="Keep the fixture directory, and print its path",
+        action="store_true",
+    )
+
+    parsed = parser.parse_args(args)
+    unknown = set(parsed.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenario(s) {0}".format(", ".join(sorted(unknown))))
+    if parsed.io_backends is None:
+        parsed.io_backends = sorted(get_kodi_addon.IO_BACKENDS)
+    return parsed
+
+
+def main(args):
+    parsed = parse_args(args)
+    parameters = {
+        key: value
+        for key, value in vars(parsed).items()
+        if key not in ("output", "keep", "log_level")
+    }
+
+    root = tempfile.mkdtemp(prefix="kodi-addon-benchmark.")
+    server = BenchmarkServer(os.path.join(root, "www"))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = []
+    try:
+        www = os.path.join(root, "www")
+        tree = dependency_tree(parsed.depth, parsed.fan_out)
+        write_packages(www, tree, parsed.package_size, parsed.checksums)
+        urls = {
+            size: write_catalog(www, size, tree, server.url, parsed.checksums)
+            for size in parsed.sizes
+        }
+        edits = write_settings(os.path.join(root, "settings"), parsed.settings)
+
+        runs = []
+        for scenario in parsed.scenarios:
+            if scenario.startswith("update-xml"):
+                runs.append((scenario, None, None))
+                continue
+            for size in parsed.sizes:
+                for io_backend in parsed.io_backends:
+                    runs.append((scenario, size, io_backend))
+
+        for scenario, size, io_backend in runs:
+            for run in range(parsed.repeat):
+                # "-warm" scenarios reuse what the matching "-cold" one left
+                # behind; everything else starts from scratch.
+                group = "update-xml" if scenario.startswith("update-xml") else scenario.split("-")[0]
+                state = os.path.join(
+                    root, "state", "{0}-{1}-{2}-{3}".format(group, size, io_backend, run)
+                )
+                if not scenario.endswith(("-warm", "-noop")):
+                    shutil.rmtree(state, ignore_errors=True)
+                    if scenario.startswith("update-xml"):
+                        shutil.copytree(os.path.join(root, "settings"), state)
+
+                spec = {
+                    "scenario": scenario,
+                    "size": size,
+                    "io_backend": io_backend,
+                    "url": urls.get(size),
+                    "data_dir": state if scenario.startswith("update-xml") else os.path.join(state, "kodi"),
+                    "cache_dir": os.path.join(state, "cache"),
+                    # Revalidate everything on warm runs, as on a host whose
+                    # cache has gone stale since the last play.
+                    "cache_ttl": 0,
+                    "install_mode": parsed.install_mode,
+                    "jobs": parsed.jobs,
+                    "lookups": parsed.lookups,
+                    "edits": edits,
+                    "log_level": parsed.log_level,
+                }
+
+                logging.info(
+                    "Running {0} (catalog size {1}, {2} I/O), run {3}".format(
+                        scenario, size, io_backend, run + 1
+                    )
+                )
+                server.counter.reset()
+                result = {
+                    "scenario": scenario,
+                    "catalog_size": size,
+                    "io_backend": io_backend,
+                    "run": run,
+                }
+                try:
+                    result.update(run_isolated(spec))
+                except Exception as e:
+                    result["error"] = str(e)
+                result.update(server.counter.snapshot())
+                results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if parsed.keep:
+            print("Kept fixtures in '{0}'".format(root), file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    output = json.dumps(
+        {
+            "format": RESULTS_FORMAT,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": parameters,
+            "results": results,
+        },
+        indent=2,
+    )
+    if parsed.output is None:
+        print(output)
+    else:
+        get_kodi_addon.write_atomically(parsed.output, (output + "\n").encode())
+
+    return 1 if any("error" in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))